@@ -3,19 +3,42 @@ import os
 import json
 import random
 import asyncio
-import aiofiles
 import aiohttp
 import toml
 from datetime import datetime, timedelta
-from typing import List, Tuple, Type, Optional, Dict, Any
+from typing import List, Tuple, Type, Optional, Dict, Any, Callable, Iterable, Iterator
 from pathlib import Path
 import re
+import bisect
+import copy
+import mmap
+import sys
+import gzip
+import hashlib
+import io
+import math
+import sqlite3
+import threading
+import atexit
+import time
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # 未安装时zstd编码退回gzip
 
 from src.plugin_system import (
     BasePlugin,
     register_plugin,
     BaseCommand,
     BaseAction,
+    BaseEventHandler,
+    EventType,
     ComponentInfo,
     ConfigField,
     ActionActivationType,
@@ -27,10 +50,13 @@ from src.plugin_system.apis import send_api, database_api
 active_sessions = {}  # {session_id: session_data}
 user_registry = {}    # {qq_number: uid}
 character_db = {}     # {rid: character_data}
+character_index = {}  # {creator_uid: {mode: set(rid)}}
 npc_db = {}           # {npc_id: npc_data}
 combat_sessions = {}  # {session_id: combat_data}
 save_db = {}          # {save_id: save_data}
 pending_checks = {}   # {check_id: check_data}
+player_session_index = {}  # {qq_number: [session_id]}，按加入顺序，最后一个为当前会话
+stream_session_index = {}  # {stream_id: [session_id]}，按创建顺序，最后一个为当前会话
 
 # --- 常量定义 ---
 PLUGIN_DIR = Path(__file__).parent.absolute()
@@ -38,9 +64,24 @@ SAVES_DIR = PLUGIN_DIR / "saves"
 USERS_DIR = PLUGIN_DIR / "users" 
 ROLES_DIR = PLUGIN_DIR / "roles"
 PLOTS_DIR = PLUGIN_DIR / "plots"
+HIBERNATE_DIR = PLUGIN_DIR / "hibernated"
+PLOT_INDEX_DIR = PLUGIN_DIR / "plot_index"
+PLOT_INDEX_VERSION = 2
+PLOT_ARTIFACT_VERSION = 1
+USER_REGISTRY_FILE = USERS_DIR / "registry.json"
+USER_REGISTRY_LOG = USERS_DIR / "registry.log"
+USER_REGISTRY_COMPACT_THRESHOLD = 500  # 追加日志超过该条数时合并到注册表文件
+DB_SNAPSHOT_FILE = PLUGIN_DIR / "db_snapshot.json"
+DB_SNAPSHOT_VERSION = 1
+COLD_LOAD_PARALLEL_THRESHOLD = 256  # 待解析文件数达到该值时并行冷加载
+COLD_LOAD_CHUNK_SIZE = 128          # 每个并行任务解析的文件数
+RETRIEVAL_SEGMENT_CHARS = 300       # 检索片段注入提示词时的最大长度
+LLM_DNS_CACHE_TTL = 300             # LLM接口域名解析缓存秒数
+LLM_KEEPALIVE_TIMEOUT = 60          # LLM接口空闲连接保持秒数
+RECORD_CODECS = {"json": ".json", "gzip": ".json.gz", "zstd": ".json.zst"}  # {编码: 文件后缀}
 
 # 创建必要目录
-for directory in [SAVES_DIR, USERS_DIR, ROLES_DIR, PLOTS_DIR]:
+for directory in [SAVES_DIR, USERS_DIR, ROLES_DIR, PLOTS_DIR, HIBERNATE_DIR, PLOT_INDEX_DIR]:
     directory.mkdir(parents=True, exist_ok=True)
 
 # 规则定义
@@ -98,99 +139,1020 @@ def generate_check_id() -> str:
     """生成检定ID"""
     return f"C{random.randint(1000, 9999)}"
 
+# === 持久化执行器 ===
+def atomic_write_json(file_path: Path, data: Any, **dump_kwargs):
+    """原子写入JSON - 先写临时文件再替换，避免写入中断留下残缺文件"""
+    temp_path = file_path.with_name(file_path.name + ".tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, **dump_kwargs)
+    os.replace(temp_path, file_path)
+
+def record_codec(path: str) -> Optional[str]:
+    """根据文件后缀判断记录文件的编码"""
+    for codec, suffix in RECORD_CODECS.items():
+        if path.endswith(suffix):
+            return codec
+    return None
+
+def resolve_record_codec(codec: str) -> str:
+    """校验配置的记录编码，不可用时退回可用编码"""
+    if codec not in RECORD_CODECS:
+        print(f"❌ 未知记录编码: {codec}，使用json")
+        return "json"
+    if codec == "zstd" and zstandard is None:
+        print("⚠️ 未安装zstandard，zstd编码退回gzip")
+        return "gzip"
+    return codec
+
+def read_record_file(path: str) -> Any:
+    """流式解码并解析记录文件，兼容未压缩的JSON文件"""
+    codec = record_codec(path)
+    if codec == "gzip":
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("未安装zstandard，无法读取zstd压缩记录")
+        with open(path, 'rb') as raw, zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+            return json.load(io.TextIOWrapper(reader, encoding='utf-8'))
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_record_file(base_path: Path, data: Any, codec: str):
+    """按编码原子写入记录文件，并移除同一记录其他编码的旧文件"""
+    file_path = base_path.with_name(base_path.name + RECORD_CODECS[codec])
+    temp_path = file_path.with_name(file_path.name + ".tmp")
+    if codec == "json":
+        atomic_write_json(file_path, data, indent=2)
+    else:
+        # 压缩格式使用紧凑JSON，边序列化边压缩写入
+        with open(temp_path, 'wb') as raw:
+            if codec == "gzip":
+                stream = gzip.GzipFile(fileobj=raw, mode='wb', mtime=0)
+            else:
+                stream = zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+            with stream, io.TextIOWrapper(stream, encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, file_path)
+    for other_codec, suffix in RECORD_CODECS.items():
+        if other_codec != codec:
+            base_path.with_name(base_path.name + suffix).unlink(missing_ok=True)
+
+def write_record_text(base_path: Path, text: str, codec: str):
+    """按编码原子写入已序列化的记录文本，并移除同一记录其他编码的旧文件"""
+    file_path = base_path.with_name(base_path.name + RECORD_CODECS[codec])
+    temp_path = file_path.with_name(file_path.name + ".tmp")
+    data = text.encode('utf-8')
+    with open(temp_path, 'wb') as raw:
+        if codec == "json":
+            raw.write(data)
+        elif codec == "gzip":
+            with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as stream:
+                stream.write(data)
+        else:
+            with zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False) as stream:
+                stream.write(data)
+    os.replace(temp_path, file_path)
+    for other_codec, suffix in RECORD_CODECS.items():
+        if other_codec != codec:
+            base_path.with_name(base_path.name + suffix).unlink(missing_ok=True)
+
+def delete_record_file(base_path: Path):
+    """删除记录的所有编码文件"""
+    for suffix in RECORD_CODECS.values():
+        base_path.with_name(base_path.name + suffix).unlink(missing_ok=True)
+
+class PersistenceExecutor:
+    """持久化执行器 - 在专用线程中按提交顺序执行所有写盘操作，避免阻塞事件循环"""
+    
+    def __init__(self):
+        # 单线程保证同一记录的多次写入按提交顺序落盘
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trpg-persistence")
+    
+    @staticmethod
+    def _run(fn: Callable, args: tuple, kwargs: Dict):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            print(f"❌ 数据写入失败 ({getattr(fn, '__name__', fn)}): {e}")
+            raise
+    
+    @staticmethod
+    def _consume_exception(future: asyncio.Future):
+        # 错误已在工作线程中打印，这里只标记异常已被处理
+        if not future.cancelled():
+            future.exception()
+    
+    def submit(self, fn: Callable, *args, **kwargs):
+        """提交写盘任务，在事件循环中调用时返回可等待对象"""
+        try:
+            future = self._pool.submit(self._run, fn, args, kwargs)
+        except RuntimeError:
+            # 解释器退出阶段线程池已关闭，直接在当前线程写入
+            return self._run(fn, args, kwargs)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return future
+        wrapped = asyncio.wrap_future(future, loop=loop)
+        wrapped.add_done_callback(self._consume_exception)
+        return wrapped
+    
+    def flush(self):
+        """阻塞等待已提交的写盘任务全部完成"""
+        try:
+            self._pool.submit(lambda: None).result()
+        except RuntimeError:
+            pass  # 线程池已关闭，剩余任务已在关闭时完成
+    
+    def shutdown(self):
+        """完成剩余写盘任务并关闭线程"""
+        self._pool.shutdown(wait=True)
+
+persistence = PersistenceExecutor()
+
+# === 冷加载 ===
+def _parse_record_chunk(paths: List[str]) -> Tuple[Dict[str, Dict], Dict[str, str]]:
+    """解析一批记录文件，返回 ({文件名: 记录}, {文件名: 错误信息})，可在工作线程中执行"""
+    records = {}
+    failures = {}
+    for path in paths:
+        name = os.path.basename(path)
+        try:
+            records[name] = read_record_file(path)
+        except Exception as e:
+            failures[name] = f"{type(e).__name__}: {e}"
+    return records, failures
+
+def parse_record_files(paths: List[str], label: str) -> Dict[str, Dict]:
+    """冷加载记录文件 - 文件较多时分批并行解析，报告失败文件和耗时"""
+    if not paths:
+        return {}
+    
+    start_time = time.perf_counter()
+    workers = 1
+    if len(paths) >= COLD_LOAD_PARALLEL_THRESHOLD:
+        workers = os.cpu_count() or 1
+    
+    if workers > 1:
+        records = {}
+        failures = {}
+        chunks = [paths[i:i + COLD_LOAD_CHUNK_SIZE] for i in range(0, len(paths), COLD_LOAD_CHUNK_SIZE)]
+        try:
+            # 使用线程池：插件初始化时宿主进程已有多个线程，fork子进程可能死锁；
+            # 文件读取和gzip/zstd解压会释放GIL，线程并行即可重叠磁盘等待
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="trpg-cold-load") as pool:
+                for chunk_records, chunk_failures in pool.map(_parse_record_chunk, chunks):
+                    records.update(chunk_records)
+                    failures.update(chunk_failures)
+        except Exception as e:
+            print(f"⚠️ 并行加载 {label} 失败，改为顺序加载: {e}")
+            workers = 1
+            records, failures = _parse_record_chunk(paths)
+    else:
+        records, failures = _parse_record_chunk(paths)
+    
+    elapsed = time.perf_counter() - start_time
+    print(f"📂 加载 {label}: 成功 {len(records)} 个，失败 {len(failures)} 个，"
+          f"耗时 {elapsed:.2f}s（{workers} 个工作线程）")
+    for name, error in list(failures.items())[:20]:
+        print(f"❌ {label}/{name}: {error}")
+    if len(failures) > 20:
+        print(f"❌ {label}: 另有 {len(failures) - 20} 个文件加载失败")
+    return records
+
+# === 存储后端 ===
+class StorageBackend(ABC):
+    """存储后端基类 - 定义用户、角色、存档的持久化接口"""
+    
+    name = "base"
+    
+    @abstractmethod
+    def load_users(self) -> Dict[str, str]:
+        """加载全部用户注册信息"""
+    
+    @abstractmethod
+    def save_user(self, qq: str, uid: str):
+        """保存一条用户注册信息"""
+    
+    @abstractmethod
+    def load_characters(self) -> Dict[str, Dict]:
+        """加载全部角色"""
+    
+    @abstractmethod
+    def save_character(self, character_data: Dict):
+        """保存角色"""
+    
+    @abstractmethod
+    def delete_character(self, rid: str):
+        """删除角色"""
+    
+    @abstractmethod
+    def load_saves(self) -> Dict[str, Dict]:
+        """加载全部存档"""
+    
+    @abstractmethod
+    def save_save(self, save_data: Dict):
+        """保存存档"""
+    
+    @abstractmethod
+    def delete_save(self, save_id: str):
+        """删除存档"""
+    
+    def transaction(self):
+        """批量写入时使用的事务上下文，默认逐条写入"""
+        return nullcontext()
+    
+    def save_snapshot(self):
+        """保存启动快照（仅部分后端需要）"""
+        pass
+    
+    def close(self):
+        """释放后端资源"""
+        pass
+
+class FileStorageBackend(StorageBackend):
+    """文件存储后端 - users/roles/saves目录下每条记录一个文件"""
+    
+    name = "file"
+    
+    def __init__(self, roles_codec: str = "json", saves_codec: str = "json"):
+        self.roles_codec = resolve_record_codec(roles_codec)  # 新写入角色文件的编码
+        self.saves_codec = resolve_record_codec(saves_codec)  # 新写入存档文件的编码
+        self.registry_log_entries = 0  # 注册日志中尚未合并的条数
+        self._snapshot = None          # 启动时读取的快照，加载完成后释放
+        self._scan_state = {}          # {section: {"files", "records"}}
+        self._snapshot_stale = False
+    
+    def load_users(self) -> Dict[str, str]:
+        """加载用户注册表 - 读取合并后的注册表文件并重放追加日志"""
+        users = {}
+        self.registry_log_entries = 0
+        
+        if USER_REGISTRY_FILE.exists():
+            try:
+                with open(USER_REGISTRY_FILE, 'r', encoding='utf-8') as f:
+                    users.update(json.load(f))
+            except Exception as e:
+                print(f"❌ 读取用户注册表失败: {e}")
+        else:
+            # 兼容旧版本：每个用户一个txt文件，首次启动时合并为单一注册表
+            for file in USERS_DIR.glob("*.txt"):
+                try:
+                    with open(file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                        users[data['qq']] = data['uid']
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"❌ 迁移旧版用户文件 {file.name} 失败: {e}")
+                    continue
+            if users:
+                self.compact_users(users)
+        
+        if USER_REGISTRY_LOG.exists():
+            with open(USER_REGISTRY_LOG, 'rb+') as f:
+                raw = f.read()
+                if raw and not raw.endswith(b"\n"):
+                    # 写入中断留下的残行：截断到最后一个完整行，否则下一条追加记录会与其拼成坏行
+                    raw = raw[:raw.rfind(b"\n") + 1]
+                    f.truncate(len(raw))
+                    print(f"⚠️ 注册日志末行不完整，已截断到 {len(raw)} 字节")
+            for line in raw.decode('utf-8', errors='replace').splitlines():
+                try:
+                    data = json.loads(line)
+                    users[data['qq']] = data['uid']
+                except (ValueError, KeyError, TypeError):
+                    continue  # 跳过损坏的记录
+                self.registry_log_entries += 1
+        return users
+    
+    def save_user(self, qq: str, uid: str):
+        """向注册日志追加一条记录"""
+        with open(USER_REGISTRY_LOG, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'qq': qq, 'uid': uid}, ensure_ascii=False) + "\n")
+        self.registry_log_entries += 1
+        if self.registry_log_entries >= USER_REGISTRY_COMPACT_THRESHOLD:
+            # 在写盘线程中执行，dict()复制为原子操作，避免事件循环同时修改注册表
+            self.compact_users(dict(user_registry))
+    
+    def compact_users(self, users: Dict[str, str]):
+        """合并注册日志到注册表文件"""
+        atomic_write_json(USER_REGISTRY_FILE, users, separators=(',', ':'))
+        # 注册表已包含日志中的全部记录，清空日志
+        with open(USER_REGISTRY_LOG, 'w', encoding='utf-8'):
+            pass
+        self.registry_log_entries = 0
+    
+    def _read_snapshot(self) -> Dict:
+        """读取启动快照（一次读取、一次解码）"""
+        if self._snapshot is None:
+            self._snapshot = {}
+            try:
+                with open(DB_SNAPSHOT_FILE, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+                if snapshot.get('version') == DB_SNAPSHOT_VERSION:
+                    self._snapshot = snapshot
+            except (OSError, ValueError):
+                pass
+        return self._snapshot
+    
+    def _load_records(self, directory: Path, key: str, section: str) -> Dict[str, Dict]:
+        """加载目录下的全部JSON记录 - 优先使用快照，只重新解析快照之后变更的文件"""
+        cached = self._read_snapshot().get(section)
+        cached_files = cached['files'] if cached else {}
+        cached_records = cached['records'] if cached else {}
+        file_records = {}
+        files = {}
+        pending = {}  # {文件名: (路径, 签名)}
+        # 逐个比对文件签名：原地修改的文件不会改变目录修改时间，不能只看目录
+        for entry in os.scandir(directory):
+            if not record_codec(entry.name):
+                continue
+            stat = entry.stat()
+            signature = [stat.st_mtime_ns, stat.st_size]
+            if cached_files.get(entry.name) == signature and entry.name in cached_records:
+                file_records[entry.name] = cached_records[entry.name]
+                files[entry.name] = signature
+            else:
+                pending[entry.name] = (entry.path, signature)
+        
+        if pending or len(files) != len(cached_files):
+            if cached:
+                print(f"🔄 {section} 快照增量刷新: 需重新解析 {len(pending)} 个文件")
+            parsed = parse_record_files([path for path, _ in pending.values()], section)
+            for name, data in parsed.items():
+                file_records[name] = data
+                files[name] = pending[name][1]
+            self._snapshot_stale = True
+        
+        self._scan_state[section] = {"files": files, "records": file_records}
+        records = {}
+        for name, data in file_records.items():
+            try:
+                records[data[key]] = data
+            except (KeyError, TypeError):
+                print(f"❌ {section}/{name}: 缺少字段 {key}")
+        return records
+    
+    def save_snapshot(self):
+        """将本次加载的角色和存档写入快照，供下次启动快速加载"""
+        self._snapshot = None
+        if not self._snapshot_stale or len(self._scan_state) < 2:
+            return
+        snapshot = {"version": DB_SNAPSHOT_VERSION}
+        snapshot.update(self._scan_state)
+        # 在当前线程完成序列化，保证快照与刚加载的数据一致，写盘交给持久化线程
+        payload = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':'))
+        self._scan_state = {}
+        self._snapshot_stale = False
+        persistence.submit(self._write_snapshot, payload)
+    
+    @staticmethod
+    def _write_snapshot(payload: str):
+        temp_path = DB_SNAPSHOT_FILE.with_name(DB_SNAPSHOT_FILE.name + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(temp_path, DB_SNAPSHOT_FILE)
+    
+    def load_characters(self) -> Dict[str, Dict]:
+        return self._load_records(ROLES_DIR, 'rid', 'roles')
+    
+    def save_character(self, character_data: Dict):
+        write_record_file(ROLES_DIR / character_data['rid'], character_data, self.roles_codec)
+    
+    def delete_character(self, rid: str):
+        delete_record_file(ROLES_DIR / rid)
+    
+    def load_saves(self) -> Dict[str, Dict]:
+        return self._load_records(SAVES_DIR, 'save_id', 'saves')
+    
+    def save_save(self, save_data: Dict):
+        write_record_file(SAVES_DIR / save_data['save_id'], save_data, self.saves_codec)
+    
+    def delete_save(self, save_id: str):
+        delete_record_file(SAVES_DIR / save_id)
+
+class SQLiteStorageBackend(StorageBackend):
+    """SQLite存储后端 - 单一数据库文件，WAL模式，按常用查询字段建索引"""
+    
+    name = "sqlite"
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS users (
+        qq TEXT PRIMARY KEY,
+        uid TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_users_uid ON users(uid);
+    CREATE TABLE IF NOT EXISTS characters (
+        rid TEXT PRIMARY KEY,
+        creator_uid TEXT,
+        mode TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_characters_owner ON characters(creator_uid, mode);
+    CREATE TABLE IF NOT EXISTS saves (
+        save_id TEXT PRIMARY KEY,
+        creator_uid TEXT,
+        status TEXT,
+        save_time TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_saves_owner ON saves(creator_uid, status);
+    CREATE INDEX IF NOT EXISTS idx_saves_time ON saves(save_time);
+    """
+    
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        # 写操作在持久化线程中执行，加锁串行化对连接的访问
+        self.lock = threading.RLock()
+        self.in_transaction = False
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+    
+    @contextmanager
+    def _write(self):
+        """写操作上下文：批量事务中只执行语句，由事务统一提交，否则单独提交"""
+        with self.lock:
+            if self.in_transaction:
+                yield
+            else:
+                with self.conn:
+                    yield
+    
+    @contextmanager
+    def transaction(self):
+        """在一个事务中执行多条写操作"""
+        with self.lock, self.conn:
+            self.in_transaction = True
+            try:
+                yield
+            finally:
+                self.in_transaction = False
+    
+    def get_meta(self, key: str) -> Optional[str]:
+        """读取元数据"""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set_meta(self, key: str, value: str):
+        """写入元数据"""
+        with self._write():
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    
+    def load_users(self) -> Dict[str, str]:
+        with self.lock:
+            return dict(self.conn.execute("SELECT qq, uid FROM users"))
+    
+    def save_user(self, qq: str, uid: str):
+        with self._write():
+            self.conn.execute("INSERT OR REPLACE INTO users (qq, uid) VALUES (?, ?)", (qq, uid))
+    
+    @staticmethod
+    def _decode_rows(rows) -> Dict[str, Dict]:
+        """解码记录行"""
+        records = {}
+        for key, data in rows:
+            try:
+                records[key] = json.loads(data)
+            except ValueError:
+                print(f"❌ 数据库记录损坏，已跳过: {key}")
+        return records
+    
+    def load_characters(self) -> Dict[str, Dict]:
+        with self.lock:
+            return self._decode_rows(self.conn.execute("SELECT rid, data FROM characters"))
+    
+    def save_character(self, character_data: Dict):
+        with self._write():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO characters (rid, creator_uid, mode, data) VALUES (?, ?, ?, ?)",
+                (character_data['rid'], character_data.get('creator_uid'), character_data.get('mode'),
+                 json.dumps(character_data, ensure_ascii=False))
+            )
+    
+    def delete_character(self, rid: str):
+        with self._write():
+            self.conn.execute("DELETE FROM characters WHERE rid = ?", (rid,))
+    
+    def load_saves(self) -> Dict[str, Dict]:
+        with self.lock:
+            return self._decode_rows(self.conn.execute("SELECT save_id, data FROM saves"))
+    
+    def save_save(self, save_data: Dict):
+        with self._write():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO saves (save_id, creator_uid, status, save_time, data) VALUES (?, ?, ?, ?, ?)",
+                (save_data['save_id'], save_data.get('creator_uid'), save_data.get('status'),
+                 save_data.get('save_time'), json.dumps(save_data, ensure_ascii=False))
+            )
+    
+    def delete_save(self, save_id: str):
+        with self._write():
+            self.conn.execute("DELETE FROM saves WHERE save_id = ?", (save_id,))
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def migrate_storage(source: StorageBackend, target: StorageBackend) -> Dict[str, int]:
+    """将一个存储后端的全部数据迁移到另一个存储后端"""
+    users = source.load_users()
+    characters = source.load_characters()
+    saves = source.load_saves()
+    
+    # 全部记录在一个事务中写入，失败时整体回滚
+    with target.transaction():
+        for qq, uid in users.items():
+            target.save_user(qq, uid)
+        for character_data in characters.values():
+            target.save_character(character_data)
+        for save_data in saves.values():
+            target.save_save(save_data)
+    
+    return {"users": len(users), "characters": len(characters), "saves": len(saves)}
+
+def create_storage_backend(plugin_instance) -> StorageBackend:
+    """根据配置创建存储后端"""
+    backend_name = plugin_instance.get_config("storage.backend", "file")
+    
+    if backend_name == "sqlite":
+        db_path = PLUGIN_DIR / plugin_instance.get_config("storage.sqlite_path", "trpg.db")
+        backend = SQLiteStorageBackend(db_path)
+        # 首次启用SQLite时，从原有目录结构一次性迁移数据
+        if not backend.get_meta("migrated_from_files"):
+            counts = migrate_storage(FileStorageBackend(), backend)
+            backend.set_meta("migrated_from_files", datetime.now().isoformat())
+            print(f"✅ 已迁移到SQLite存储: 用户{counts['users']}个，角色{counts['characters']}个，存档{counts['saves']}个")
+        return backend
+    
+    if backend_name != "file":
+        print(f"❌ 未知存储后端: {backend_name}，使用文件存储")
+    return FileStorageBackend(
+        roles_codec=plugin_instance.get_config("storage.roles_codec", "json"),
+        saves_codec=plugin_instance.get_config("storage.saves_codec", "json")
+    )
+
+storage_backend: StorageBackend = FileStorageBackend()
+
 def load_user_registry():
     """加载用户注册表"""
     global user_registry
-    user_registry = {}
-    for file in USERS_DIR.glob("*.txt"):
-        try:
-            with open(file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                user_registry[data['qq']] = data['uid']
-        except:
-            continue
-
-def save_user_registry():
-    """保存用户注册表"""
-    for qq, uid in user_registry.items():
-        file_path = USERS_DIR / f"{qq}{uid[-4:]}.txt"
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump({'qq': qq, 'uid': uid}, f, ensure_ascii=False)
+    user_registry = storage_backend.load_users()
+
+def save_user_registry(qq: str, uid: str):
+    """保存用户注册信息（异步写盘）"""
+    return persistence.submit(storage_backend.save_user, qq, uid)
+
+def index_character(character_data: Dict):
+    """登记角色到创建者索引"""
+    by_mode = character_index.setdefault(character_data.get("creator_uid"), {})
+    by_mode.setdefault(character_data.get("mode"), set()).add(character_data["rid"])
+
+def unindex_character(character_data: Dict):
+    """从创建者索引中移除角色"""
+    creator_uid = character_data.get("creator_uid")
+    mode = character_data.get("mode")
+    by_mode = character_index.get(creator_uid)
+    if not by_mode or mode not in by_mode:
+        return
+    by_mode[mode].discard(character_data["rid"])
+    if not by_mode[mode]:
+        del by_mode[mode]
+    if not by_mode:
+        del character_index[creator_uid]
 
 def load_character_db():
     """加载角色数据库"""
-    global character_db
-    character_db = {}
-    for file in ROLES_DIR.glob("*.json"):
+    global character_db, character_index
+    character_db = storage_backend.load_characters()
+    character_index = {}
+    for data in character_db.values():
+        index_character(data)
+
+class CharacterWriteBehind:
+    """角色写回缓存 - 标记脏角色，合并窗口内的多次修改只写盘一次"""
+    
+    def __init__(self, window: float = 5.0):
+        self.window = window  # 合并窗口（秒），0表示立即写盘
+        self.dirty = set()    # {rid}
+        self._timer = None
+        self.stats = {"marked": 0, "written": 0}
+    
+    def mark_dirty(self, rid: str):
+        """标记角色已修改，窗口到期后统一写盘"""
+        self.dirty.add(rid)
+        self.stats["marked"] += 1
+        if self._timer is not None:
+            return
         try:
-            with open(file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                character_db[data['rid']] = data
-        except:
-            continue
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or self.window <= 0:
+            self.flush()
+        else:
+            self._timer = loop.call_later(self.window, self.flush)
+    
+    def discard(self, rid: str):
+        """取消角色的待写入标记"""
+        self.dirty.discard(rid)
+    
+    def flush(self):
+        """立即写入全部脏角色"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        dirty, self.dirty = self.dirty, set()
+        for rid in dirty:
+            character_data = character_db.get(rid)
+            if character_data:
+                persistence.submit(storage_backend.save_character, copy.deepcopy(character_data))
+                self.stats["written"] += 1
+
+character_write_behind = CharacterWriteBehind()
+
+def flush_pending_writes():
+    """写入全部缓存中的修改并等待写盘完成"""
+    character_write_behind.flush()
+    persistence.flush()
+
+atexit.register(flush_pending_writes)
 
 def save_character(character_data: Dict):
-    """保存角色数据"""
-    file_path = ROLES_DIR / f"{character_data['rid']}.json"
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(character_data, f, ensure_ascii=False, indent=2)
+    """保存角色数据（异步写盘，返回可等待对象）"""
+    character_db[character_data['rid']] = character_data
+    index_character(character_data)
+    character_write_behind.discard(character_data['rid'])
+    # 写盘线程中序列化期间事件循环可能继续修改角色，提交快照
+    return persistence.submit(storage_backend.save_character, copy.deepcopy(character_data))
+
+def mark_character_dirty(character_data: Dict):
+    """标记角色已修改，由写回缓存合并后写盘（适用于战斗、物品等高频修改）"""
+    character_write_behind.mark_dirty(character_data['rid'])
 
 def delete_character(rid: str):
     """删除角色数据"""
-    file_path = ROLES_DIR / f"{rid}.json"
-    if file_path.exists():
-        file_path.unlink()
+    character_write_behind.discard(rid)
+    persistence.submit(storage_backend.delete_character, rid)
     if rid in character_db:
+        unindex_character(character_db[rid])
         del character_db[rid]
 
+class SaveCatalogue:
+    """存档目录 - 按创建者和状态索引，按存档时间排序（启动时随存档数据库一起重建）"""
+    
+    def __init__(self):
+        self.entries = {}     # {save_id: entry}
+        self.by_owner = {}    # {creator_uid: {status: set(save_id)}}
+        self.time_order = []  # [(save_time, save_id)]，按存档时间升序
+    
+    @staticmethod
+    def _make_entry(save_data: Dict) -> Dict:
+        """提取目录条目所需的存档摘要"""
+        return {
+            'save_id': save_data['save_id'],
+            'plot_name': save_data.get('plot_name', ''),
+            'save_time': save_data.get('save_time', '2000-01-01'),
+            'player_count': len(save_data.get('players', [])),
+            'mode': save_data.get('mode', 'coc'),
+            'creator_uid': save_data.get('creator_uid'),
+            'status': save_data.get('status')
+        }
+    
+    def _insert(self, entry: Dict):
+        """写入内存索引"""
+        save_id = entry['save_id']
+        if save_id in self.entries:
+            self._discard(save_id)
+        self.entries[save_id] = entry
+        by_status = self.by_owner.setdefault(entry['creator_uid'], {})
+        by_status.setdefault(entry['status'], set()).add(save_id)
+        bisect.insort(self.time_order, (entry['save_time'], save_id))
+    
+    def _discard(self, save_id: str) -> Optional[Dict]:
+        """移除内存索引"""
+        entry = self.entries.pop(save_id, None)
+        if not entry:
+            return None
+        by_status = self.by_owner.get(entry['creator_uid'], {})
+        save_ids = by_status.get(entry['status'])
+        if save_ids is not None:
+            save_ids.discard(save_id)
+            if not save_ids:
+                del by_status[entry['status']]
+            if not by_status:
+                del self.by_owner[entry['creator_uid']]
+        key = (entry['save_time'], save_id)
+        pos = bisect.bisect_left(self.time_order, key)
+        if pos < len(self.time_order) and self.time_order[pos] == key:
+            del self.time_order[pos]
+        return entry
+    
+    def add(self, save_data: Dict):
+        """登记存档"""
+        self._insert(self._make_entry(save_data))
+    
+    def remove(self, save_id: str):
+        """注销存档"""
+        self._discard(save_id)
+    
+    def remove_many(self, save_ids: List[str]):
+        """批量注销存档"""
+        for save_id in save_ids:
+            self._discard(save_id)
+    
+    def rebuild(self, saves: List[Dict]):
+        """根据存档数据重建目录"""
+        self.entries = {}
+        self.by_owner = {}
+        self.time_order = []
+        for save_data in saves:
+            self._insert(self._make_entry(save_data))
+    
+    def count(self, creator_uid: str, status: str = 'incomplete') -> int:
+        """统计用户指定状态的存档数量"""
+        return len(self.by_owner.get(creator_uid, {}).get(status, ()))
+    
+    def list(self, creator_uid: str, status: str = 'incomplete') -> List[Dict]:
+        """按存档时间列出用户指定状态的存档"""
+        save_ids = self.by_owner.get(creator_uid, {}).get(status, ())
+        return sorted((self.entries[save_id] for save_id in save_ids), key=lambda e: e['save_time'])
+    
+    def expired(self, cutoff_time: str) -> List[str]:
+        """获取存档时间早于截止时间的存档ID"""
+        pos = bisect.bisect_left(self.time_order, (cutoff_time, ''))
+        return [save_id for _, save_id in self.time_order[:pos]]
+
+save_catalogue = SaveCatalogue()
+
+class SaveDeltaChain:
+    """增量存档链 - 存档只记录相对同一会话上一次存档变化的字段"""
+    
+    # 增量记录中除变化字段外始终保留的摘要字段（供存储后端建立索引）
+    HEADER_FIELDS = ('save_id', 'session_id', 'creator_uid', 'status', 'save_time')
+    
+    def __init__(self, enabled: bool = False, max_length: int = 8):
+        self.enabled = enabled
+        self.max_length = max_length
+        self.parents = {}   # {save_id: parent_save_id}
+        self.depth = {}     # {save_id: 链深度}，完整存档为0
+        self.children = {}  # {parent_save_id: set(save_id)}
+        self.heads = {}     # {session_id: 该会话最近一次存档ID}
+        self.stats = {"full": 0, "delta": 0, "compacted": 0}
+    
+    @staticmethod
+    def is_delta(record: Dict) -> bool:
+        """判断磁盘记录是否为增量记录"""
+        return 'delta_parent' in record
+    
+    def _link(self, save_id: str, parent_id: Optional[str]):
+        """登记存档的父存档"""
+        self._unlink(save_id)
+        if parent_id is None:
+            self.depth[save_id] = 0
+            return
+        self.parents[save_id] = parent_id
+        self.depth[save_id] = self.depth.get(parent_id, 0) + 1
+        self.children.setdefault(parent_id, set()).add(save_id)
+    
+    def _unlink(self, save_id: str):
+        """解除存档与父存档的关联"""
+        parent_id = self.parents.pop(save_id, None)
+        if parent_id is not None:
+            siblings = self.children.get(parent_id)
+            if siblings is not None:
+                siblings.discard(save_id)
+                if not siblings:
+                    del self.children[parent_id]
+        self.depth.pop(save_id, None)
+    
+    def materialize(self, records: Dict[str, Dict]) -> Dict[str, Dict]:
+        """将磁盘记录还原为完整存档，未变化的字段与父存档共享"""
+        self.parents = {}
+        self.depth = {}
+        self.children = {}
+        self.heads = {}
+        saves = {}
+        broken = set()
+        for save_id in records:
+            # 沿父链向上找到已还原的存档或完整存档，再自顶向下依次应用增量
+            chain = []
+            current = save_id
+            while current not in saves and current not in broken:
+                record = records.get(current)
+                if record is None or current in chain:
+                    broken.update(chain)
+                    print(f"❌ 存档 {save_id} 的增量链断裂: 缺少父存档 {current}")
+                    break
+                chain.append(current)
+                if not self.is_delta(record):
+                    break
+                current = record['delta_parent']
+            if chain and chain[-1] in broken:
+                continue
+            if current in broken:
+                broken.update(chain)
+                continue
+            for chain_id in reversed(chain):
+                record = records[chain_id]
+                if self.is_delta(record):
+                    parent_id = record['delta_parent']
+                    save_data = dict(saves[parent_id])
+                    save_data.update(record['delta'])
+                    for key in record.get('delta_removed', []):
+                        save_data.pop(key, None)
+                    self._link(chain_id, parent_id)
+                else:
+                    save_data = record
+                    self._link(chain_id, None)
+                saves[chain_id] = save_data
+        
+        # 每个会话以最近的存档作为下一次增量存档的基准
+        latest = {}
+        for save_id, save_data in saves.items():
+            session_id = save_data.get('session_id')
+            save_time = save_data.get('save_time', '')
+            if session_id and save_time >= latest.get(session_id, ('', None))[0]:
+                latest[session_id] = (save_time, save_id)
+        self.heads = {session_id: save_id for session_id, (_, save_id) in latest.items()}
+        return saves
+    
+    def encode(self, save_data: Dict) -> Tuple[Dict, Dict]:
+        """生成新存档的内存记录和写盘记录 - 无基准或链过长时写完整存档"""
+        save_id = save_data['save_id']
+        parent_id = self.heads.get(save_data.get('session_id'))
+        self.heads[save_data.get('session_id')] = save_id
+        
+        if (not self.enabled or parent_id not in save_db
+                or self.depth.get(parent_id, 0) + 1 > self.max_length):
+            save_data = copy.deepcopy(save_data)
+            self._link(save_id, None)
+            self.stats["full"] += 1
+            return save_data, save_data
+        
+        base = save_db[parent_id]
+        changed = {key: copy.deepcopy(value) for key, value in save_data.items()
+                   if key not in base or base[key] != value}
+        removed = [key for key in base if key not in save_data]
+        stored = dict(base)
+        stored.update(changed)
+        for key in removed:
+            stored.pop(key, None)
+        
+        record = {key: stored.get(key) for key in self.HEADER_FIELDS}
+        record.update({"delta_parent": parent_id, "delta": changed, "delta_removed": removed})
+        self._link(save_id, parent_id)
+        self.stats["delta"] += 1
+        return stored, record
+    
+    def rebase(self, save_id: str):
+        """将增量存档写为完整存档，并把其后代的链深度相应缩短"""
+        if save_id not in self.parents:
+            return
+        shift = self.depth.get(save_id, 0)
+        self._link(save_id, None)
+        pending = list(self.children.get(save_id, ()))
+        while pending:
+            child_id = pending.pop()
+            self.depth[child_id] -= shift
+            pending.extend(self.children.get(child_id, ()))
+        persistence.submit(storage_backend.save_save, save_db[save_id])
+        self.stats["compacted"] += 1
+    
+    def detach(self, save_id: str):
+        """删除存档前将依赖它的增量存档折叠为完整存档"""
+        for child_id in list(self.children.get(save_id, ())):
+            self.rebase(child_id)
+        self._unlink(save_id)
+        for session_id, head_id in list(self.heads.items()):
+            if head_id == save_id:
+                del self.heads[session_id]
+    
+    def compact(self) -> int:
+        """折叠超过最大链长的增量存档；关闭增量模式时折叠全部增量存档"""
+        max_length = self.max_length if self.enabled else 0
+        compacted = 0
+        for save_id in sorted(self.parents, key=lambda sid: self.depth.get(sid, 0)):
+            if self.depth.get(save_id, 0) > max_length:
+                self.rebase(save_id)
+                compacted += 1
+        return compacted
+
+save_delta_chain = SaveDeltaChain()
+
 def load_save_db():
     """加载存档数据库"""
     global save_db
-    save_db = {}
-    for file in SAVES_DIR.glob("*.json"):
-        try:
-            with open(file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                save_db[data['save_id']] = data
-        except:
-            continue
+    save_db = save_delta_chain.materialize(storage_backend.load_saves())
+    # 旧版存档内嵌剧本正文的截断副本，没有读取方，加载时丢弃，避免在内存中重复持有
+    for save_data in save_db.values():
+        if "plot_content" in save_data:
+            del save_data["plot_content"]
+            save_data.setdefault("plot_ref", None)
+    compacted = save_delta_chain.compact()
+    if compacted:
+        print(f"🔄 已将 {compacted} 个增量存档折叠为完整存档")
+    save_catalogue.rebuild(list(save_db.values()))
 
 def save_save_data(save_data: Dict):
-    """保存存档数据"""
-    file_path = SAVES_DIR / f"{save_data['save_id']}.json"
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(save_data, f, ensure_ascii=False, indent=2)
+    """保存存档数据（增量模式下只写入相对上一次存档变化的字段）"""
+    stored, record = save_delta_chain.encode(save_data)
+    save_db[stored['save_id']] = stored
+    save_catalogue.add(stored)
+    return persistence.submit(storage_backend.save_save, record)
 
 def delete_save(save_id: str):
     """删除存档"""
-    file_path = SAVES_DIR / f"{save_id}.json"
-    if file_path.exists():
-        file_path.unlink()
+    if save_id in save_db:
+        save_delta_chain.detach(save_id)
+    persistence.submit(storage_backend.delete_save, save_id)
     if save_id in save_db:
         del save_db[save_id]
-
-async def load_plot_content(plot_name: str) -> Optional[str]:
-    """加载剧本内容 - 仅支持txt文件"""
-    plot_path = PLOTS_DIR / plot_name
+    save_catalogue.remove(save_id)
+
+def delete_saves(save_ids: List[str]) -> List:
+    """批量删除存档，返回写盘任务"""
+    futures = []
+    for save_id in save_ids:
+        if save_id in save_db:
+            save_delta_chain.detach(save_id)
+            del save_db[save_id]
+        futures.append(persistence.submit(storage_backend.delete_save, save_id))
+    save_catalogue.remove_many(save_ids)
+    return futures
+
+class PlotCatalogue:
+    """剧本目录 - 缓存剧本列表和元数据，只在剧本目录修改时间变化时重新扫描"""
     
-    if not plot_path.exists():
-        return None
-        
-    try:
-        # 只支持txt文件
-        if plot_path.suffix.lower() == '.txt':
-            async with aiofiles.open(plot_path, 'r', encoding='utf-8') as f:
-                return await f.read()
-        else:
-            return f"❌ 不支持的文件格式: {plot_path.suffix}，请使用.txt文件"
-                
-    except Exception as e:
-        print(f"加载剧本失败 {plot_name}: {e}")
-        return f"❌ 剧本文件读取失败: {str(e)}"
+    def __init__(self):
+        self.entries = {}      # {plot_name: {"size", "mtime", "segments", "scenes"}}
+        self.dir_mtime = None
+        self.stats = {"scans": 0, "hits": 0}
+    
+    def refresh(self):
+        """剧本目录有增删时重新扫描"""
+        try:
+            dir_mtime = PLOTS_DIR.stat().st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        if dir_mtime is not None and dir_mtime == self.dir_mtime:
+            self.stats["hits"] += 1
+            return
+        
+        entries = {}
+        if dir_mtime is not None:
+            for entry in os.scandir(PLOTS_DIR):
+                if not entry.name.endswith(".txt") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                previous = self.entries.get(entry.name)
+                # 文件未变化时保留已统计的段落数
+                segments = None
+                scenes = None
+                if previous and previous["mtime"] == stat.st_mtime_ns and previous["size"] == stat.st_size:
+                    segments = previous["segments"]
+                    scenes = previous["scenes"]
+                entries[entry.name] = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                                       "segments": segments, "scenes": scenes}
+        self.entries = entries
+        self.dir_mtime = dir_mtime
+        self.stats["scans"] += 1
+    
+    def names(self) -> List[str]:
+        """按名称排序的剧本列表"""
+        self.refresh()
+        return sorted(self.entries)
+    
+    def contains(self, plot_name: str) -> bool:
+        """检查剧本是否存在"""
+        self.refresh()
+        return plot_name in self.entries
+    
+    async def describe(self) -> List[Tuple[str, Dict]]:
+        """列出剧本及元数据，段落数和场景数在首次列出时从编译产物读取"""
+        self.refresh()
+        result = []
+        for plot_name in sorted(self.entries):
+            entry = self.entries[plot_name]
+            if entry["segments"] is None:
+                artifact = await plot_compiler.get(plot_name)
+                entry["segments"] = artifact["segments"] if artifact else 0
+                entry["scenes"] = len(artifact["scenes"]) if artifact else 0
+            result.append((plot_name, entry))
+        return result
+
+plot_catalogue = PlotCatalogue()
 
 def get_available_plots() -> List[str]:
     """获取可用剧本列表 - 只显示txt文件"""
-    return [f.name for f in PLOTS_DIR.glob("*.txt")]
+    return plot_catalogue.names()
 
 def is_admin(user_id: str, plugin_instance) -> bool:
     """检查用户是否为管理员"""
@@ -203,6 +1165,286 @@ def is_session_creator(user_id: str, session_id: str) -> bool:
         return str(active_sessions[session_id]['creator']) == str(user_id)
     return False
 
+def _index_add(index: Dict[str, List[str]], key: str, session_id: str):
+    """将会话追加到索引列表末尾，成为当前会话"""
+    session_ids = index.setdefault(key, [])
+    if session_id in session_ids:
+        session_ids.remove(session_id)
+    session_ids.append(session_id)
+
+def _index_remove(index: Dict[str, List[str]], key: str, session_id: str):
+    """从索引列表移除会话，之前的会话重新成为当前会话"""
+    session_ids = index.get(key)
+    if session_ids and session_id in session_ids:
+        session_ids.remove(session_id)
+        if not session_ids:
+            del index[key]
+
+def index_player(player: Dict, session_id: str):
+    """登记玩家所在会话，最近加入的会话成为该玩家的当前会话"""
+    _index_add(player_session_index, str(player["qq"]), session_id)
+
+def unindex_player(player: Dict, session_id: str):
+    """移除玩家的会话索引，玩家仍在的上一个会话重新成为当前会话"""
+    _index_remove(player_session_index, str(player["qq"]), session_id)
+
+def index_stream(stream_id: str, session_id: str):
+    """登记聊天流中的会话，新会话成为该聊天的当前会话"""
+    _index_add(stream_session_index, stream_id, session_id)
+
+def unindex_stream(stream_id: str, session_id: str):
+    """移除聊天流中的会话，之前的会话重新成为当前会话"""
+    _index_remove(stream_session_index, stream_id, session_id)
+
+async def get_session(session_id: str) -> Optional[Dict]:
+    """根据会话ID获取会话，休眠中的会话自动恢复"""
+    session = active_sessions.get(session_id)
+    if session is None:
+        session = await session_hibernator.rehydrate(session_id)
+    return session
+
+def touch_session(session: Dict):
+    """记录会话活动时间，供空闲回收和休眠判断"""
+    session["last_activity"] = datetime.now().isoformat()
+
+async def get_user_session(user_id: str) -> Optional[Dict]:
+    """根据QQ号获取用户当前所在会话，玩家的每条会话内命令都经过这里，同时记录活动时间"""
+    session_ids = player_session_index.get(str(user_id))
+    if not session_ids:
+        return None
+    session = await get_session(session_ids[-1])
+    if session is not None:
+        touch_session(session)
+    return session
+
+async def get_stream_session(stream_id: str) -> Optional[Dict]:
+    """根据聊天流ID获取该聊天中的当前会话"""
+    session_ids = stream_session_index.get(stream_id)
+    if not session_ids:
+        return None
+    return await get_session(session_ids[-1])
+
+def get_session_player(session: Dict, user_id: str) -> Optional[Dict]:
+    """获取会话中的玩家数据"""
+    for player in session["players"]:
+        if str(player["qq"]) == str(user_id):
+            return player
+    return None
+
+async def get_user_character(user_id: str) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """获取用户当前会话及已加载的角色"""
+    session = await get_user_session(user_id)
+    if not session:
+        return None, None
+    player = get_session_player(session, user_id)
+    if not player or not player.get("character_rid"):
+        return None, None
+    return session, character_db[player["character_rid"]]
+
+def register_session(session: Dict):
+    """登记新会话及其聊天流索引"""
+    session_id = session["session_id"]
+    active_sessions[session_id] = session
+    index_stream(session["stream_id"], session_id)
+
+def close_session(session_id: str):
+    """关闭会话并清理玩家、聊天流索引以及KP状态、战斗、NPC和待处理检定"""
+    for check_id in [cid for cid, check in pending_checks.items() if check.get("session_id") == session_id]:
+        del pending_checks[check_id]
+    # 休眠中的会话只需清理其索引和磁盘文件
+    session_hibernator.discard(session_id)
+    session = active_sessions.pop(session_id, None)
+    if not session:
+        return
+    for player in session["players"]:
+        unindex_player(player, session_id)
+    unindex_stream(session.get("stream_id"), session_id)
+    if kp_driver:
+        kp_driver.session_states.pop(session_id, None)
+    combat_sessions.pop(session_id, None)
+    for npc in session.get("npcs", []):
+        if npc_db.get(npc.get("npc_id"), {}).get("session_id") == session_id:
+            del npc_db[npc["npc_id"]]
+
+def create_session_save(session: Dict) -> Dict:
+    """根据会话当前状态创建存档"""
+    kp_state = kp_driver.session_states.get(session["session_id"]) if kp_driver else None
+    save_data = {
+        "save_id": generate_save_id(),
+        "session_id": session["session_id"],
+        "plot_name": session["plot_name"],
+        "plot_ref": session.get("plot_ref"),
+        "mode": session["mode"],
+        "max_players": session["max_players"],
+        "players": session["players"],
+        "npcs": session["npcs"],
+        "items": session.get("items", []),
+        "current_progress": session["current_progress"],
+        "plot_progress": session.get("plot_progress", 0),
+        "save_time": datetime.now().isoformat(),
+        "creator": session["creator"],
+        "creator_uid": session["creator_uid"],
+        "status": "incomplete",
+        "kp_driver_data": kp_state  # 保存KP状态
+    }
+    # 保存到数据库和文件
+    save_save_data(save_data)
+    return save_data
+
+class SessionHibernator:
+    """会话休眠 - 将长期空闲的进行中会话写入磁盘并移出内存，下次访问时透明恢复"""
+    
+    def __init__(self, idle_hours: float = 0, interval: float = 10 * 60):
+        self.idle_hours = idle_hours  # 为0时不休眠
+        self.interval = interval
+        self.sessions = {}  # {session_id: 休眠会话摘要}，玩家和聊天流索引保持指向休眠会话
+        self.stats = {"hibernated": 0, "rehydrated": 0}
+    
+    @staticmethod
+    def _path(session_id: str) -> Path:
+        return HIBERNATE_DIR / session_id
+    
+    @staticmethod
+    def _make_stub(session: Dict) -> Dict:
+        """提取休眠期间需要常驻内存的会话摘要"""
+        return {
+            "stream_id": session.get("stream_id"),
+            "last_activity": session.get("last_activity", session.get("created_time", "")),
+            "players": [{"qq": player["qq"], "uid": player["uid"], "character_rid": player.get("character_rid")}
+                        for player in session["players"]]
+        }
+    
+    def uses_character(self, rid: str) -> bool:
+        """检查休眠会话中是否有玩家使用该角色"""
+        return any(player.get("character_rid") == rid
+                   for stub in self.sessions.values() for player in stub["players"])
+    
+    @staticmethod
+    def _serialize(session_id: str) -> str:
+        """序列化会话及其KP状态和战斗，得到一致的快照"""
+        return json.dumps({
+            "session": active_sessions[session_id],
+            "kp_state": kp_driver.session_states.get(session_id) if kp_driver else None,
+            "combat": combat_sessions.get(session_id)
+        }, ensure_ascii=False, separators=(',', ':'))
+    
+    async def hibernate(self, session_id: str) -> bool:
+        """将会话及其KP状态、战斗和NPC写入磁盘，写盘成功且期间未被修改时才移出内存"""
+        session = active_sessions[session_id]
+        # 在事件循环中完成序列化，压缩和写盘交给持久化线程
+        snapshot = self._serialize(session_id)
+        try:
+            result = persistence.submit(write_record_text, self._path(session_id), snapshot, "gzip")
+            if asyncio.isfuture(result):
+                await result
+        except Exception as e:
+            print(f"❌ 休眠会话 {session_id} 写盘失败，会话保留在内存中: {e}")
+            return False
+        if active_sessions.get(session_id) is not session or self._serialize(session_id) != snapshot:
+            # 写盘期间会话被使用、修改或关闭，放弃本次休眠
+            persistence.submit(delete_record_file, self._path(session_id))
+            return False
+        
+        del active_sessions[session_id]
+        if kp_driver:
+            kp_driver.session_states.pop(session_id, None)
+        combat_sessions.pop(session_id, None)
+        for npc in session.get("npcs", []):
+            if npc_db.get(npc.get("npc_id")) is npc:
+                del npc_db[npc["npc_id"]]
+        self.sessions[session_id] = self._make_stub(session)
+        self.stats["hibernated"] += 1
+        return True
+    
+    async def rehydrate(self, session_id: str, touch: bool = True) -> Optional[Dict]:
+        """从磁盘恢复休眠会话，读取文件在线程中进行"""
+        if session_id not in self.sessions:
+            return None
+        file_path = self._path(session_id).with_name(session_id + RECORD_CODECS["gzip"])
+        try:
+            payload = await asyncio.to_thread(read_record_file, str(file_path))
+        except Exception as e:
+            if session_id in self.sessions:
+                print(f"❌ 恢复休眠会话 {session_id} 失败: {e}")
+                return None
+        if session_id not in self.sessions:
+            # 等待期间已被其他请求恢复（文件随之删除）或被关闭
+            return active_sessions.get(session_id)
+        
+        del self.sessions[session_id]
+        session = payload["session"]
+        active_sessions[session_id] = session
+        if payload.get("kp_state") is not None and kp_driver:
+            kp_driver.session_states[session_id] = payload["kp_state"]
+        if payload.get("combat") is not None:
+            combat_sessions[session_id] = payload["combat"]
+        for npc in session.get("npcs", []):
+            if npc.get("session_id") == session_id:
+                npc_db[npc["npc_id"]] = npc
+        if touch:
+            session["last_activity"] = datetime.now().isoformat()
+        persistence.submit(delete_record_file, self._path(session_id))
+        self.stats["rehydrated"] += 1
+        return session
+    
+    def discard(self, session_id: str):
+        """丢弃休眠会话，清理其玩家和聊天流索引以及磁盘文件"""
+        stub = self.sessions.pop(session_id, None)
+        if stub is None:
+            return
+        for player in stub["players"]:
+            unindex_player(player, session_id)
+        unindex_stream(stub["stream_id"], session_id)
+        persistence.submit(delete_record_file, self._path(session_id))
+    
+    async def hibernate_idle(self) -> int:
+        """休眠空闲超过时限的进行中会话，返回休眠数量"""
+        if self.idle_hours <= 0:
+            return 0
+        cutoff_time = (datetime.now() - timedelta(hours=self.idle_hours)).isoformat()
+        count = 0
+        for session_id, session in list(active_sessions.items()):
+            # 招募和准备阶段有各自的计时器，只休眠进行中的会话
+            if session.get("status") != "playing":
+                continue
+            if session.get("last_activity", session.get("created_time", "")) >= cutoff_time:
+                continue
+            try:
+                if await self.hibernate(session_id):
+                    count += 1
+            except Exception as e:
+                print(f"❌ 休眠会话 {session_id} 失败: {e}")
+        if count:
+            print(f"💤 已休眠 {count} 个空闲超过 {self.idle_hours} 小时的会话")
+        return count
+    
+    def restore(self):
+        """启动时登记上次运行遗留的休眠会话，恢复其玩家和聊天流索引"""
+        restored = []
+        for entry in os.scandir(HIBERNATE_DIR):
+            if not entry.name.endswith(RECORD_CODECS["gzip"]):
+                continue
+            session_id = entry.name[:-len(RECORD_CODECS["gzip"])]
+            if session_id in active_sessions or session_id in self.sessions:
+                continue
+            try:
+                session = read_record_file(entry.path)["session"]
+            except Exception as e:
+                print(f"❌ 读取休眠会话 {entry.name} 失败: {e}")
+                continue
+            restored.append((session.get("created_time", ""), session_id, session))
+        # 按创建顺序登记，同一聊天或玩家的较新会话成为当前会话
+        restored.sort(key=lambda item: item[0])
+        for _, session_id, session in restored:
+            self.sessions[session_id] = self._make_stub(session)
+            index_stream(session["stream_id"], session_id)
+            for player in session["players"]:
+                index_player(player, session_id)
+        if self.sessions:
+            print(f"💤 已登记 {len(self.sessions)} 个休眠会话")
+
+session_hibernator = SessionHibernator()
+
 def check_user_registered(user_id: str) -> Tuple[bool, str]:
     """检查用户是否注册"""
     if str(user_id) not in user_registry:
@@ -215,15 +1457,8 @@ def get_user_characters_count(user_id: str) -> Dict[str, int]:
     if not user_uid:
         return {"coc": 0, "dnd": 0}
     
-    coc_count = 0
-    dnd_count = 0
-    for character in character_db.values():
-        if character.get("creator_uid") == user_uid:
-            if character.get("mode") == "coc":
-                coc_count += 1
-            elif character.get("mode") == "dnd":
-                dnd_count += 1
-    return {"coc": coc_count, "dnd": dnd_count}
+    by_mode = character_index.get(user_uid, {})
+    return {"coc": len(by_mode.get("coc", ())), "dnd": len(by_mode.get("dnd", ()))}
 
 def validate_character_attributes(mode: str, attributes: Dict) -> Tuple[bool, str]:
     """验证角色属性是否符合规则"""
@@ -254,32 +1489,18 @@ def get_user_characters(user_id: str) -> List[Dict]:
         return []
     
     user_characters = []
-    for character in character_db.values():
-        if character.get("creator_uid") == user_uid:
-            user_characters.append(character)
+    for rids in character_index.get(user_uid, {}).values():
+        user_characters.extend(character_db[rid] for rid in rids)
+    user_characters.sort(key=lambda c: c.get("created_time", ""))
     return user_characters
 
 def get_user_saves_count(user_uid: str) -> int:
     """获取用户未完成存档数量"""
-    count = 0
-    for save_data in save_db.values():
-        if save_data.get('creator_uid') == user_uid and save_data.get('status') == 'incomplete':
-            count += 1
-    return count
+    return save_catalogue.count(user_uid, 'incomplete')
 
 def get_user_saves_list(user_uid: str) -> List[Dict]:
     """获取用户的存档列表"""
-    user_saves = []
-    for save_data in save_db.values():
-        if save_data.get('creator_uid') == user_uid and save_data.get('status') == 'incomplete':
-            user_saves.append({
-                'save_id': save_data['save_id'],
-                'plot_name': save_data['plot_name'],
-                'save_time': save_data['save_time'],
-                'player_count': len(save_data.get('players', [])),
-                'mode': save_data.get('mode', 'coc')
-            })
-    return user_saves
+    return save_catalogue.list(user_uid, 'incomplete')
 
 def generate_random_character(mode: str, name: str = "随机角色") -> Dict:
     """生成随机角色"""
@@ -310,7 +1531,6 @@ def generate_random_character(mode: str, name: str = "随机角色") -> Dict:
     }
     
     # 保存角色
-    character_db[rid] = character_data
     save_character(character_data)
     
     return character_data
@@ -547,6 +1767,581 @@ class CheckSystem:
             f"💬 {description}"
         )
 
+# === 剧本缓存 ===
+class ScriptCache:
+    """剧本缓存 - 缓存剧本的分段信息和派生数据（检索索引、段落标注），不持有剧本全文；
+    按内存预算淘汰最久未使用的剧本，剧本文件修改后自动失效"""
+    
+    def __init__(self, budget_bytes: int = 32 * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()  # {plot_name: entry}，按最近使用排序
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0,
+                      "memo_hits": 0, "memo_misses": 0}
+    
+    @staticmethod
+    def _file_mtime(plot_name: str) -> Optional[int]:
+        try:
+            return (PLOTS_DIR / plot_name).stat().st_mtime_ns
+        except OSError:
+            return None
+    
+    def _drop(self, plot_name: str) -> Optional[Dict]:
+        entry = self.entries.pop(plot_name, None)
+        if entry:
+            self.total_bytes -= entry['size']
+        return entry
+    
+    def get(self, plot_name: str) -> Optional[Dict]:
+        """获取缓存的剧本，文件已修改或删除时视为未命中"""
+        entry = self.entries.get(plot_name)
+        if entry is not None and entry['mtime'] != self._file_mtime(plot_name):
+            self._drop(plot_name)
+            self.stats["invalidations"] += 1
+            entry = None
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(plot_name)
+        self.stats["hits"] += 1
+        return entry
+    
+    def put(self, plot_name: str, table: Dict) -> Dict:
+        """缓存剧本条目，超出预算时淘汰最久未使用的剧本"""
+        self._drop(plot_name)
+        entry = {
+            'title': plot_name,
+            'sha256': table['sha256'],
+            'segments': len(table['offsets']),
+            'loaded_time': datetime.now().isoformat(),
+            'mtime': table['mtime'],
+            'size': 512
+        }
+        self.entries[plot_name] = entry
+        self.total_bytes += entry['size']
+        # 至少保留刚加载的剧本，即使它单独超出预算
+        while self.total_bytes > self.budget_bytes and len(self.entries) > 1:
+            self._drop(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+        return entry
+    
+    async def load(self, plot_name: str) -> Optional[Dict]:
+        """获取剧本，未命中时通过分段表登记（分段表有索引文件时无需扫描剧本）"""
+        entry = self.get(plot_name)
+        if entry is not None:
+            return entry
+        table = await plot_segments.get_table(plot_name)
+        if not table:
+            return None
+        return self.put(plot_name, table)
+    
+    def charge(self, plot_name: str, extra_bytes: int):
+        """计入剧本派生数据（如检索索引）占用的内存，必要时淘汰其他剧本"""
+        entry = self.entries.get(plot_name)
+        if entry is None:
+            return
+        entry['size'] += extra_bytes
+        self.total_bytes += extra_bytes
+        self.entries.move_to_end(plot_name)
+        while self.total_bytes > self.budget_bytes and len(self.entries) > 1:
+            self._drop(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+    
+    def memo_get(self, plot_name: str, key: Tuple) -> Optional[Any]:
+        """读取剧本的派生数据缓存（如段落标注）"""
+        entry = self.entries.get(plot_name)
+        memo = entry.get('memo') if entry else None
+        if memo is not None and key in memo:
+            self.stats["memo_hits"] += 1
+            return memo[key]
+        self.stats["memo_misses"] += 1
+        return None
+    
+    def memo_put(self, plot_name: str, key: Tuple, value: Any, size: int):
+        """写入派生数据缓存，随剧本一起失效和淘汰；调用方需先载入剧本"""
+        entry = self.entries.get(plot_name)
+        if entry is None:
+            return
+        entry.setdefault('memo', {})[key] = value
+        self.charge(plot_name, size)
+    
+    def hit_rate(self) -> float:
+        """剧本缓存命中率"""
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+    
+    def memo_hit_rate(self) -> float:
+        """派生数据缓存命中率"""
+        total = self.stats["memo_hits"] + self.stats["memo_misses"]
+        return self.stats["memo_hits"] / total if total else 0.0
+    
+    def report(self) -> str:
+        """缓存状态摘要"""
+        mb = 1024 * 1024
+        return (f"🧠 剧本缓存: {len(self.entries)}个剧本，{self.total_bytes / mb:.1f}/{self.budget_bytes / mb:.1f}MB，"
+                f"命中率 {self.hit_rate():.0%}，段落标注命中率 {self.memo_hit_rate():.0%}，淘汰 {self.stats['evictions']} 次")
+    
+    def __contains__(self, plot_name: str) -> bool:
+        return plot_name in self.entries
+
+class PlotSegmentTable:
+    """剧本分段表 - 剧本按空行分段，各段的字节偏移和长度持久化到索引文件，段落通过内存映射按需读取"""
+    
+    # 与按文本模式读取后 split('\n\n') 的分段一致：\r\n、\r、\n 都视为换行
+    SEPARATOR = re.compile(rb'(?:\r\n|\r|\n){2}')
+    
+    def __init__(self):
+        self.tables = {}  # {plot_name: {"mtime", "size", "sha256", "offsets", "lengths"}}
+        self.stats = {"builds": 0, "index_loads": 0, "hits": 0}
+    
+    @staticmethod
+    def _index_path(plot_name: str) -> Path:
+        return PLOT_INDEX_DIR / f"{plot_name}.idx"
+    
+    @classmethod
+    def _build(cls, plot_path: Path, mtime: int, size: int) -> Dict:
+        """通过内存映射扫描剧本文件，计算各段的字节偏移和长度以及文件哈希"""
+        offsets = array('q')
+        lengths = array('q')
+        start = 0
+        with open(plot_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            sha256 = hashlib.sha256(data).hexdigest()
+            if data.find(b'\r') < 0:
+                # 只有\n换行时直接查找分隔符，比正则扫描快得多
+                pos = data.find(b'\n\n')
+                while pos >= 0:
+                    offsets.append(start)
+                    lengths.append(pos - start)
+                    start = pos + 2
+                    pos = data.find(b'\n\n', start)
+            else:
+                for match in cls.SEPARATOR.finditer(data):
+                    offsets.append(start)
+                    lengths.append(match.start() - start)
+                    start = match.end()
+        offsets.append(start)
+        lengths.append(size - start)
+        return {"mtime": mtime, "size": size, "sha256": sha256, "offsets": offsets, "lengths": lengths}
+    
+    @staticmethod
+    def _read_index(index_path: Path, mtime: int, size: int) -> Optional[Dict]:
+        """读取索引文件，与剧本文件不一致时返回None"""
+        try:
+            with open(index_path, 'rb') as f:
+                header = json.loads(f.readline())
+                if (header.get("version") != PLOT_INDEX_VERSION
+                        or header.get("mtime") != mtime or header.get("size") != size):
+                    return None
+                offsets = array('q')
+                lengths = array('q')
+                offsets.frombytes(f.read(header["count"] * offsets.itemsize))
+                lengths.frombytes(f.read(header["count"] * lengths.itemsize))
+        except (OSError, ValueError, KeyError):
+            return None
+        if len(offsets) != header["count"] or len(lengths) != header["count"]:
+            return None
+        return {"mtime": mtime, "size": size, "sha256": header["sha256"], "offsets": offsets, "lengths": lengths}
+    
+    @staticmethod
+    def _write_index(index_path: Path, table: Dict):
+        """写入索引文件：JSON头一行，之后是偏移和长度数组"""
+        header = {"version": PLOT_INDEX_VERSION, "mtime": table["mtime"], "size": table["size"],
+                  "sha256": table["sha256"], "count": len(table["offsets"])}
+        temp_path = index_path.with_name(index_path.name + ".tmp")
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(table["offsets"].tobytes())
+            f.write(table["lengths"].tobytes())
+        os.replace(temp_path, index_path)
+    
+    async def get_table(self, plot_name: str) -> Optional[Dict]:
+        """获取剧本分段表 - 依次使用内存缓存、索引文件，都失效时才扫描剧本文件"""
+        plot_path = PLOTS_DIR / plot_name
+        if plot_path.suffix.lower() != '.txt':
+            return None
+        try:
+            stat = plot_path.stat()
+        except OSError:
+            return None
+        if not stat.st_size:
+            return None
+        
+        table = self.tables.get(plot_name)
+        if table and table['mtime'] == stat.st_mtime_ns and table['size'] == stat.st_size:
+            self.stats["hits"] += 1
+            return table
+        
+        index_path = self._index_path(plot_name)
+        table = self._read_index(index_path, stat.st_mtime_ns, stat.st_size)
+        if table:
+            self.stats["index_loads"] += 1
+        else:
+            try:
+                table = await asyncio.to_thread(self._build, plot_path, stat.st_mtime_ns, stat.st_size)
+            except Exception as e:
+                print(f"加载剧本失败 {plot_name}: {e}")
+                return None
+            persistence.submit(self._write_index, index_path, table)
+            self.stats["builds"] += 1
+        self.tables[plot_name] = table
+        return table
+    
+    @staticmethod
+    def iter_segments(plot_name: str, table: Dict) -> Iterator[str]:
+        """通过内存映射逐段解码剧本，供在线程中流式建立索引，不持有全文"""
+        with open(PLOTS_DIR / plot_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, length in zip(table['offsets'], table['lengths']):
+                raw = data[offset:offset + length]
+                yield raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    
+    async def read_segment(self, plot_name: str, index: int) -> Optional[str]:
+        """通过内存映射只解码指定的剧本段落，超出范围时返回None"""
+        table = await self.get_table(plot_name)
+        if not table or not 0 <= index < len(table['offsets']):
+            return None
+        offset = table['offsets'][index]
+        with open(PLOTS_DIR / plot_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            raw = data[offset:offset + table['lengths'][index]]
+        return raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+plot_segments = PlotSegmentTable()
+
+class PlotCompiler:
+    """剧本编译 - 将剧本文本解析为场景、线索和NPC提示，产物按文件哈希缓存，运行时无需重新解析文本"""
+    
+    SCENE_PATTERN = re.compile(r'^\s*(?:#+\s*|【)?(?:第[一二三四五六七八九十百零\d]+[幕章节场回]|场景|序章|尾声|[Ss]cene\s*\d+)')
+    CLUE_PATTERN = re.compile(r'(?:线索|[Cc]lue)\s*\d*\s*[:：]\s*(.+)')
+    NPC_PATTERN = re.compile(r'(?:NPC|npc|人物)\s*[:：]\s*([^\s，,。；;（(：:]+)')
+    STAT_PATTERN = re.compile(r'(STR|CON|DEX|APP|POW|SIZ|INT|EDU|HP|MP|SAN|力量|体质|敏捷|外貌|意志|体型|智力|教育|生命|理智)\s*[:：]?\s*(\d+)', re.I)
+    
+    def __init__(self):
+        self.artifacts = {}  # {plot_name: artifact}，按sha256校验
+        self.stats = {"compiled": 0, "loaded": 0, "hits": 0}
+    
+    @classmethod
+    def compile_segments(cls, segments: Iterable[str]) -> Dict:
+        """逐段解析剧本，段落序号与剧本分段表一致"""
+        scenes = []
+        clues = []
+        npcs = []
+        count = 0
+        for segment_id, segment in enumerate(segments):
+            count += 1
+            lines = [line.strip() for line in segment.split('\n') if line.strip()]
+            if lines and cls.SCENE_PATTERN.match(lines[0]):
+                scenes.append({"title": lines[0].strip('#【】 ')[:40], "segment": segment_id})
+            for line in lines:
+                clue = cls.CLUE_PATTERN.search(line)
+                if clue:
+                    clues.append({"text": clue.group(1).strip()[:100], "segment": segment_id})
+                npc = cls.NPC_PATTERN.search(line)
+                if npc:
+                    stats = {name.upper(): int(value) for name, value in cls.STAT_PATTERN.findall(line)}
+                    npcs.append({"name": npc.group(1), "segment": segment_id, "stats": stats})
+        return {"segments": count, "scenes": scenes, "clues": clues, "npcs": npcs}
+    
+    @classmethod
+    def _compile_file(cls, plot_name: str, table: Dict) -> Dict:
+        artifact = cls.compile_segments(PlotSegmentTable.iter_segments(plot_name, table))
+        artifact.update({"version": PLOT_ARTIFACT_VERSION, "sha256": table["sha256"]})
+        return artifact
+    
+    @staticmethod
+    def _artifact_path(sha256: str) -> Path:
+        return PLOT_INDEX_DIR / f"{sha256}.plot.json"
+    
+    @staticmethod
+    def _prepare(artifact: Dict) -> Dict:
+        """建立运行时查找表，返回副本以免写入产物文件"""
+        segment_clues = {}
+        for clue in artifact["clues"]:
+            segment_clues.setdefault(clue["segment"], []).append(clue["text"])
+        prepared = dict(artifact)
+        prepared["segment_clues"] = segment_clues
+        prepared["scene_starts"] = [scene["segment"] for scene in artifact["scenes"]]
+        return prepared
+    
+    async def get(self, plot_name: str) -> Optional[Dict]:
+        """获取剧本编译产物，文件内容变化时重新编译"""
+        table = await plot_segments.get_table(plot_name)
+        if not table:
+            return None
+        sha256 = table["sha256"]
+        artifact = self.artifacts.get(plot_name)
+        if artifact and artifact["sha256"] == sha256:
+            self.stats["hits"] += 1
+            return artifact
+        
+        artifact_path = self._artifact_path(sha256)
+        try:
+            with open(artifact_path, 'r', encoding='utf-8') as f:
+                artifact = json.load(f)
+            if artifact.get("version") != PLOT_ARTIFACT_VERSION:
+                artifact = None
+        except (OSError, ValueError):
+            artifact = None
+        
+        if artifact:
+            self.stats["loaded"] += 1
+        else:
+            try:
+                artifact = await asyncio.to_thread(self._compile_file, plot_name, table)
+            except Exception as e:
+                print(f"❌ 编译剧本失败 {plot_name}: {e}")
+                return None
+            persistence.submit(atomic_write_json, artifact_path, artifact, separators=(',', ':'))
+            self.stats["compiled"] += 1
+        artifact = self._prepare(artifact)
+        self.artifacts[plot_name] = artifact
+        return artifact
+    
+    @staticmethod
+    def scene_at(artifact: Dict, segment_id: int) -> Optional[str]:
+        """获取段落所属场景的标题"""
+        pos = bisect.bisect_right(artifact["scene_starts"], segment_id)
+        return artifact["scenes"][pos - 1]["title"] if pos else None
+
+plot_compiler = PlotCompiler()
+
+class PlotRetrievalIndex:
+    """剧本检索 - 以汉字二元组和英文单词为词项建立段落倒排索引，按BM25检索相关段落"""
+    
+    TOKEN_PATTERN = re.compile(r'[\u4e00-\u9fff]+|[A-Za-z0-9]+')
+    K1 = 1.5
+    B = 0.75
+    
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        """汉字连续片段切为二元组（单字保留为一元），英文和数字按单词小写"""
+        tokens = []
+        for run in cls.TOKEN_PATTERN.findall(text):
+            if run[0].isascii():
+                tokens.append(run.lower())
+            elif len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        return tokens
+    
+    @classmethod
+    def build(cls, segments: Iterable[str]) -> Dict:
+        """逐段建立倒排索引，段落序号与剧本分段表一致"""
+        postings = {}  # {词项: {段落序号: 词频}}
+        doc_lengths = array('i')
+        for segment_id, segment in enumerate(segments):
+            tokens = cls.tokenize(segment)
+            doc_lengths.append(len(tokens))
+            for token in tokens:
+                counts = postings.setdefault(token, {})
+                counts[segment_id] = counts.get(segment_id, 0) + 1
+        
+        # 转为紧凑数组保存
+        compact = {}
+        size = sys.getsizeof(doc_lengths)
+        for token, counts in postings.items():
+            segment_ids = array('i', counts.keys())
+            frequencies = array('i', counts.values())
+            compact[token] = (segment_ids, frequencies)
+            size += sys.getsizeof(token) + sys.getsizeof(segment_ids) + sys.getsizeof(frequencies) + 64
+        size += sys.getsizeof(compact)
+        indexed = sum(1 for length in doc_lengths if length)
+        return {
+            "postings": compact,
+            "doc_lengths": doc_lengths,
+            "avg_length": (sum(doc_lengths) / indexed) if indexed else 0.0,
+            "size": size
+        }
+    
+    @classmethod
+    def search(cls, index: Dict, query: str, top_k: int) -> List[int]:
+        """返回与查询最相关的段落序号，按相关度降序"""
+        query_terms = set(cls.tokenize(query))
+        if not query_terms or not index["avg_length"]:
+            return []
+        doc_lengths = index["doc_lengths"]
+        total = len(doc_lengths)
+        scores = {}
+        for term in query_terms:
+            posting = index["postings"].get(term)
+            if not posting:
+                continue
+            segment_ids, frequencies = posting
+            idf = math.log(1 + (total - len(segment_ids) + 0.5) / (len(segment_ids) + 0.5))
+            for segment_id, frequency in zip(segment_ids, frequencies):
+                norm = cls.K1 * (1 - cls.B + cls.B * doc_lengths[segment_id] / index["avg_length"])
+                scores[segment_id] = scores.get(segment_id, 0.0) + idf * frequency * (cls.K1 + 1) / (frequency + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [segment_id for segment_id, _ in ranked[:top_k]]
+
+# === 关键词匹配 ===
+# 行动影响关键词，按顺序判定优先级
+DEFAULT_IMPACT_KEYWORDS = {
+    "positive": ["帮助", "治疗", "保护", "合作", "调查", "寻找", "询问", "探索"],
+    "negative": ["攻击", "破坏", "偷窃", "欺骗", "威胁", "逃跑", "忽视"],
+    "creative": ["创造", "发明", "组合", "使用", "尝试", "推理", "解决"]
+}
+
+# 剧情建议规则，按顺序输出
+DEFAULT_SUGGESTION_RULES = {
+    "combat": {"keywords": ["战斗", "敌人", "攻击"],
+               "suggestions": ["⚔️ 准备战斗", "🛡️ 采取防御姿态", "🔍 寻找掩护"]},
+    "mystery": {"keywords": ["谜题", "谜团", "秘密"],
+                "suggestions": ["🔎 调查线索", "💭 思考推理", "🗣️ 讨论分析"]},
+    "social": {"keywords": ["社交", "对话", "交谈"],
+               "suggestions": ["🗣️ 进行对话", "🎭 角色扮演", "🤝 建立关系"]},
+    "explore": {"keywords": ["探索", "地点", "房间"],
+                "suggestions": ["🔍 搜索环境", "📝 记录发现", "🗺️ 绘制地图"]},
+    "danger": {"keywords": ["危险", "陷阱", "威胁"],
+               "suggestions": ["⚠️ 谨慎前进", "🔍 侦查危险", "🎯 准备检定"]}
+}
+
+class KeywordMatcher:
+    """多模式关键词匹配 - Aho-Corasick自动机，一次线性扫描找出文本命中的所有类别"""
+    
+    def __init__(self, patterns: Dict[str, List[str]]):
+        self.goto = [{}]     # 各状态的转移表
+        self.fail = [0]      # 失配指针
+        self.output = [set()]  # 到达该状态时命中的类别（含失配链上的类别）
+        for label, keywords in patterns.items():
+            for keyword in keywords:
+                self._add(keyword.lower(), label)
+        self._link()
+    
+    def _add(self, keyword: str, label: str):
+        if not keyword:
+            return
+        state = 0
+        for char in keyword:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(set())
+            state = next_state
+        self.output[state].add(label)
+    
+    def _link(self):
+        """按层序建立失配指针，并合并失配链上的输出"""
+        queue = list(self.goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.output[next_state] |= self.output[self.fail[next_state]]
+    
+    def match(self, text: str) -> set:
+        """返回文本命中的全部类别"""
+        labels = set()
+        state = 0
+        goto = self.goto
+        fail = self.fail
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if self.output[state]:
+                labels |= self.output[state]
+        return labels
+
+class KeywordEngine:
+    """关键词引擎 - 由关键词表构建自动机，用于行动影响判定和剧情建议"""
+    
+    def __init__(self):
+        self.impact_keywords = copy.deepcopy(DEFAULT_IMPACT_KEYWORDS)
+        self.suggestion_rules = copy.deepcopy(DEFAULT_SUGGESTION_RULES)
+        self.rebuild()
+    
+    def rebuild(self):
+        """根据当前关键词表重建自动机"""
+        self.impact_matcher = KeywordMatcher(self.impact_keywords)
+        self.suggestion_matcher = KeywordMatcher(
+            {name: rule["keywords"] for name, rule in self.suggestion_rules.items()}
+        )
+    
+    def load_custom(self, file_path: Path) -> bool:
+        """加载自定义关键词词典（JSON），追加到默认关键词表"""
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                custom = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"❌ 加载关键词词典失败 {file_path}: {e}")
+            return False
+        error = self._validate_custom(custom)
+        if error:
+            print(f"❌ 关键词词典格式错误 {file_path}: {error}")
+            return False
+        
+        for impact, keywords in custom.get("impact", {}).items():
+            self.impact_keywords.setdefault(impact, []).extend(keywords)
+        for name, rule in custom.get("suggestions", {}).items():
+            target = self.suggestion_rules.setdefault(name, {"keywords": [], "suggestions": []})
+            target["keywords"].extend(rule.get("keywords", []))
+            target["suggestions"].extend(rule.get("suggestions", []))
+        self.rebuild()
+        total = sum(len(keywords) for keywords in self.impact_keywords.values()) + \
+            sum(len(rule["keywords"]) for rule in self.suggestion_rules.values())
+        print(f"✅ 已加载关键词词典: {file_path}（共 {total} 个关键词）")
+        return True
+    
+    @staticmethod
+    def _validate_custom(custom) -> Optional[str]:
+        """校验自定义词典结构，返回错误描述；全部校验通过后才合并，避免只合并一半"""
+        def is_str_list(value) -> bool:
+            return isinstance(value, list) and all(isinstance(item, str) for item in value)
+        
+        if not isinstance(custom, dict):
+            return "顶层必须是对象"
+        impact = custom.get("impact", {})
+        if not isinstance(impact, dict):
+            return "impact 必须是对象"
+        for name, keywords in impact.items():
+            if not is_str_list(keywords):
+                return f"impact.{name} 必须是字符串列表"
+        suggestions = custom.get("suggestions", {})
+        if not isinstance(suggestions, dict):
+            return "suggestions 必须是对象"
+        for name, rule in suggestions.items():
+            if not isinstance(rule, dict):
+                return f"suggestions.{name} 必须是对象"
+            for key in ("keywords", "suggestions"):
+                if not is_str_list(rule.get(key, [])):
+                    return f"suggestions.{name}.{key} 必须是字符串列表"
+        return None
+    
+    def classify_action(self, text: str) -> str:
+        """判定行动影响，多类命中时按关键词表顺序取第一个"""
+        labels = self.impact_matcher.match(text.lower())
+        for impact in self.impact_keywords:
+            if impact in labels:
+                return impact
+        return "neutral"
+    
+    def suggestion_labels(self, text: str) -> frozenset:
+        """获取文本命中的建议规则"""
+        return frozenset(self.suggestion_matcher.match(text.lower()))
+    
+    def suggestions_for(self, text: str, known_labels: frozenset = frozenset()) -> List[str]:
+        """按规则顺序汇总文本命中的所有建议，known_labels为已知命中的规则"""
+        labels = set(known_labels)
+        if text:
+            labels |= self.suggestion_matcher.match(text.lower())
+        suggestions = []
+        for name, rule in self.suggestion_rules.items():
+            if name in labels:
+                suggestions.extend(rule["suggestions"])
+        return suggestions
+
+keyword_engine = KeywordEngine()
+
 # === 剧情推进系统 ===
 class PlotAdvancer:
     """剧情推进器"""
@@ -560,61 +2355,73 @@ class PlotAdvancer:
         session = active_sessions[session_id]
         plot_name = session["plot_name"]
         
-        # 加载剧本内容
-        plot_content = await load_plot_content(plot_name)
-        if not plot_content:
+        # 加载剧本分段表（缓存，文件修改后重建）
+        table = await plot_segments.get_table(plot_name)
+        if not table:
             return f"❌ 剧本 '{plot_name}' 不存在或加载失败"
         
-        # 获取当前进度
+        # 获取当前进度，只读取对应的段落
         current_progress = session.get("plot_progress", 0)
+        segment = await plot_segments.read_segment(plot_name, current_progress)
         
         # 分析玩家行为并生成下一段剧情
-        next_plot_text = await PlotAdvancer._generate_next_plot(
-            plot_content, current_progress, player_action, session
-        )
+        next_plot_text = await PlotAdvancer._generate_next_plot(segment, player_action, session)
         
         # 更新进度
         session["plot_progress"] = current_progress + 1
         session["last_activity"] = datetime.now().isoformat()
         
-        # 生成操作建议
-        suggestions = await PlotAdvancer._generate_suggestions(next_plot_text, session)
+        # 本段的线索、所属场景和建议类别（按段落缓存）
+        annotations = await kp_driver.segment_annotations(plot_name, current_progress) if kp_driver else None
+        if annotations is None:
+            annotations = {"suggestion_labels": frozenset(), "scene": None, "clues": []}
+        new_clues = []
+        kp_state = kp_driver.session_states.get(session_id) if kp_driver else None
+        for clue in annotations["clues"]:
+            if kp_state is not None:
+                if clue in kp_state['discovered_clues']:
+                    continue
+                kp_state['discovered_clues'].append(clue)
+            new_clues.append(clue)
+        scene = annotations["scene"]
+        
+        # 生成操作建议（段落部分使用缓存的匹配结果，只扫描附加的行动文本）
+        extra_text = next_plot_text[len(segment):] if segment else next_plot_text
+        suggestions = await PlotAdvancer._generate_suggestions(
+            extra_text, session, annotations["suggestion_labels"]
+        )
         
         # 组合响应
         response = f"📖 **剧情推进**\n\n{next_plot_text}\n\n"
+        if new_clues:
+            response += "🔎 **发现线索:**\n" + "\n".join(f"- {clue}" for clue in new_clues) + "\n\n"
         if suggestions:
             response += f"💡 **建议操作:**\n{suggestions}\n\n"
         
-        response += f"📊 进度: {session['plot_progress'] + 1}/未知"
+        response += f"📊 进度: {min(session['plot_progress'], len(table['offsets']))}/{len(table['offsets'])}"
+        if scene:
+            response += f" · 🎬 {scene}"
         
         return response
     
     @staticmethod
-    async def _generate_next_plot(plot_content: str, current_progress: int, 
-                                player_action: str, session: Dict) -> str:
+    async def _generate_next_plot(segment: Optional[str], player_action: str, session: Dict) -> str:
         """生成下一段剧情文本"""
-        # 分割剧本内容
-        plot_segments = plot_content.split('\n\n')
-        
         # 如果有玩家行为，结合行为生成剧情
         if player_action:
             return await PlotAdvancer._generate_plot_with_action(
-                plot_segments, current_progress, player_action, session
+                segment or "", player_action, session
             )
         else:
             # 无行为时按顺序推进
-            if current_progress < len(plot_segments):
-                return plot_segments[current_progress]
+            if segment is not None:
+                return segment
             else:
                 return "🎭 剧本已结束。感谢参与！"
     
     @staticmethod
-    async def _generate_plot_with_action(plot_segments: List[str], current_progress: int,
-                                       player_action: str, session: Dict) -> str:
+    async def _generate_plot_with_action(base_plot: str, player_action: str, session: Dict) -> str:
         """结合玩家行为生成剧情"""
-        # 简化的剧情生成逻辑
-        base_plot = plot_segments[current_progress] if current_progress < len(plot_segments) else ""
-        
         # 根据玩家行为调整剧情
         action_impact = await PlotAdvancer._analyze_action_impact(player_action, session)
         
@@ -632,48 +2439,13 @@ class PlotAdvancer:
     @staticmethod
     async def _analyze_action_impact(player_action: str, session: Dict) -> str:
         """分析玩家行为的影响"""
-        action_lower = player_action.lower()
-        
-        # 简单关键词分析
-        positive_keywords = ["帮助", "治疗", "保护", "合作", "调查", "寻找", "询问", "探索"]
-        negative_keywords = ["攻击", "破坏", "偷窃", "欺骗", "威胁", "逃跑", "忽视"]
-        creative_keywords = ["创造", "发明", "组合", "使用", "尝试", "推理", "解决"]
-        
-        for keyword in positive_keywords:
-            if keyword in action_lower:
-                return "positive"
-        
-        for keyword in negative_keywords:
-            if keyword in action_lower:
-                return "negative"
-        
-        for keyword in creative_keywords:
-            if keyword in action_lower:
-                return "creative"
-        
-        return "neutral"
+        return keyword_engine.classify_action(player_action)
     
     @staticmethod
-    async def _generate_suggestions(plot_text: str, session: Dict) -> str:
+    async def _generate_suggestions(plot_text: str, session: Dict, known_labels: frozenset = frozenset()) -> str:
         """根据剧情生成操作建议"""
-        suggestions = []
-        plot_lower = plot_text.lower()
-        
-        # 基于剧情内容生成建议
-        if any(word in plot_lower for word in ["战斗", "敌人", "攻击"]):
-            suggestions.extend(["⚔️ 准备战斗", "🛡️ 采取防御姿态", "🔍 寻找掩护"])
-        
-        if any(word in plot_lower for word in ["谜题", "谜团", "秘密"]):
-            suggestions.extend(["🔎 调查线索", "💭 思考推理", "🗣️ 讨论分析"])
-        
-        if any(word in plot_lower for word in ["社交", "对话", "交谈"]):
-            suggestions.extend(["🗣️ 进行对话", "🎭 角色扮演", "🤝 建立关系"])
-        
-        if any(word in plot_lower for word in ["探索", "地点", "房间"]):
-            suggestions.extend(["🔍 搜索环境", "📝 记录发现", "🗺️ 绘制地图"])
-        
-        if any(word in plot_lower for word in ["危险", "陷阱", "威胁"]):
-            suggestions.extend(["⚠️ 谨慎前进", "🔍 侦查危险", "🎯 准备检定"])
+        # 基于剧情内容生成建议（一次扫描匹配全部建议规则）
+        suggestions = keyword_engine.suggestions_for(plot_text, known_labels)
         
         # 添加通用建议
         if not suggestions:
@@ -691,26 +2463,42 @@ class IntelligentKPDriver:
     """智能KP驱动器 - 在剧本框架内自由发挥"""
     
     def __init__(self, plugin_instance=None):
-        self.script_cache = {}
+        cache_mb = plugin_instance.get_config("game.script_cache_mb", 32) if plugin_instance else 32
+        self.script_cache = ScriptCache(int(cache_mb * 1024 * 1024))
         self.session_states = {}
+        self.retrieval_locks = {}  # {plot_name: asyncio.Lock}，同一剧本的检索索引只构建一次
         self.plugin = plugin_instance  # 保存插件实例引用
+        self.http_session = None  # 共享的LLM接口会话，首次请求时创建
+    
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """获取共享的HTTP会话，复用连接池和已建立的连接"""
+        if self.http_session is None or self.http_session.closed:
+            limit = self.plugin.get_config("llm.max_connections", 8) if self.plugin else 8
+            connector = aiohttp.TCPConnector(
+                limit=limit,
+                ttl_dns_cache=LLM_DNS_CACHE_TTL,
+                keepalive_timeout=LLM_KEEPALIVE_TIMEOUT
+            )
+            self.http_session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=30)
+            )
+        return self.http_session
+    
+    async def close(self):
+        """关闭共享的HTTP会话"""
+        if self.http_session is not None and not self.http_session.closed:
+            await self.http_session.close()
+        self.http_session = None
     
     async def initialize_script(self, session_id: str, plot_name: str) -> bool:
         """初始化剧本缓存"""
         if session_id not in active_sessions:
             return False
         
-        plot_content = await load_plot_content(plot_name)
-        if not plot_content:
+        # 登记剧本缓存条目（只读取分段表，不加载全文）
+        if not await self.script_cache.load(plot_name):
             return False
         
-        # 缓存完整剧本内容
-        self.script_cache[plot_name] = {
-            'content': plot_content,
-            'title': plot_name,
-            'loaded_time': datetime.now().isoformat()
-        }
-        
         # 初始化会话状态
         self.session_states[session_id] = {
             'plot_name': plot_name,
@@ -721,6 +2509,24 @@ class IntelligentKPDriver:
         
         return True
     
+    async def segment_annotations(self, plot_name: str, segment_id: int) -> Optional[Dict]:
+        """获取段落的派生标注（场景、线索、建议类别），按剧本哈希和段落序号挂在剧本缓存条目上，随剧本一起淘汰"""
+        script_data = await self.script_cache.load(plot_name)
+        if not script_data or not 0 <= segment_id < script_data['segments']:
+            return None
+        key = (script_data['sha256'], segment_id)
+        annotations = self.script_cache.memo_get(plot_name, key)
+        if annotations is None:
+            artifact = await plot_compiler.get(plot_name)
+            segment = await plot_segments.read_segment(plot_name, segment_id)
+            annotations = {
+                "suggestion_labels": keyword_engine.suggestion_labels(segment or ""),
+                "scene": PlotCompiler.scene_at(artifact, segment_id) if artifact else None,
+                "clues": artifact["segment_clues"].get(segment_id, []) if artifact else []
+            }
+            self.script_cache.memo_put(plot_name, key, annotations, sys.getsizeof(annotations) + 256)
+        return annotations
+    
     async def generate_kp_response(self, session_id: str, player_action: str = "") -> str:
         """生成简洁的KP响应（120字内）"""
         if session_id not in self.session_states:
@@ -729,13 +2535,37 @@ class IntelligentKPDriver:
         session_state = self.session_states[session_id]
         plot_name = session_state['plot_name']
         
-        if plot_name not in self.script_cache:
+        # 剧本可能已被淘汰或文件已修改，按需重新加载
+        script_data = await self.script_cache.load(plot_name)
+        if not script_data:
             return "❌ 剧本数据丢失"
         
-        script_data = self.script_cache[plot_name]
+        # 检索与玩家行动相关的剧本片段
+        excerpts = await self._retrieve_excerpts(script_data, player_action)
+        
+        # 剧本编译产物中的人物和已发现线索
+        artifact = await plot_compiler.get(plot_name)
+        
+        # 当前进度所在段落的标注（按段落缓存）
+        segment_id = min(session_state['progress'], script_data['segments'] - 1)
+        annotations = await self.segment_annotations(plot_name, segment_id)
+        scene = annotations["scene"] if annotations else None
+        
+        # 当前段落和行动检索到的段落中的线索视为已发现
+        discovered_clues = session_state.setdefault('discovered_clues', [])
+        new_clues = []
+        for clue_segment in dict.fromkeys([segment_id] + [excerpt_id for excerpt_id, _ in excerpts]):
+            if clue_segment != segment_id:
+                annotations = await self.segment_annotations(plot_name, clue_segment)
+            for clue in (annotations["clues"] if annotations else []):
+                if clue not in discovered_clues:
+                    discovered_clues.append(clue)
+                    new_clues.append(clue)
         
         # 构建简洁提示词
-        prompt = self._build_concise_prompt(script_data, session_state, player_action)
+        prompt = self._build_concise_prompt(
+            script_data, session_state, player_action, [text for _, text in excerpts], artifact, scene
+        )
         
         # 调用LLM生成简短响应
         llm_response = await self._call_llm_api(prompt)
@@ -748,6 +2578,9 @@ class IntelligentKPDriver:
             words = llm_response.split()
             llm_response = ' '.join(words[:25]) + "..."
         
+        if new_clues:
+            llm_response += "\n🔎 发现线索: " + "；".join(new_clues)
+        
         # 更新状态
         session_state['progress'] += 1
         if player_action:
@@ -755,15 +2588,59 @@ class IntelligentKPDriver:
         
         return llm_response
     
-    def _build_concise_prompt(self, script_data: Dict, session_state: Dict, player_action: str) -> str:
+    async def _retrieve_excerpts(self, script_data: Dict, player_action: str) -> List[Tuple[int, str]]:
+        """按玩家行动检索剧本中最相关的若干段落，返回 [(段落序号, 片段)]，索引随剧本缓存一起淘汰"""
+        top_k = self.plugin.get_config("llm.retrieval_top_k", 3) if self.plugin else 3
+        if not player_action or top_k <= 0:
+            return []
+        plot_name = script_data['title']
+        index = script_data.get('retrieval')
+        if index is None:
+            async with self.retrieval_locks.setdefault(plot_name, asyncio.Lock()):
+                # 等待锁期间其他请求可能已构建完成
+                index = script_data.get('retrieval')
+                if index is None:
+                    table = await plot_segments.get_table(plot_name)
+                    if not table:
+                        return []
+                    index = await asyncio.to_thread(
+                        lambda: PlotRetrievalIndex.build(PlotSegmentTable.iter_segments(plot_name, table))
+                    )
+                    script_data['retrieval'] = index
+                    # 构建期间剧本可能已被淘汰或重新加载，只计入仍在缓存中的这一份
+                    if self.script_cache.entries.get(plot_name) is script_data:
+                        self.script_cache.charge(plot_name, index['size'])
+        
+        excerpts = []
+        for segment_id in PlotRetrievalIndex.search(index, player_action, top_k):
+            segment = await plot_segments.read_segment(plot_name, segment_id)
+            if segment and segment.strip():
+                excerpts.append((segment_id, segment.strip()[:RETRIEVAL_SEGMENT_CHARS]))
+        return excerpts
+    
+    def _build_concise_prompt(self, script_data: Dict, session_state: Dict, player_action: str,
+                              excerpts: Optional[List[str]] = None, artifact: Optional[Dict] = None,
+                              scene: Optional[str] = None) -> str:
         """构建简洁提示词"""
+        excerpt_text = ""
+        if scene:
+            excerpt_text += f"当前场景：{scene}\n"
+        if artifact and artifact["npcs"]:
+            names = list(dict.fromkeys(npc["name"] for npc in artifact["npcs"]))[:8]
+            excerpt_text += f"剧本人物：{'、'.join(names)}\n"
+        if session_state.get('discovered_clues'):
+            excerpt_text += f"已发现线索：{'；'.join(session_state['discovered_clues'][-5:])}\n"
+        if excerpts:
+            excerpt_text += "剧本相关片段：\n" + "\n".join(f"[{i}] {text}" for i, text in enumerate(excerpts, 1)) + "\n"
+        if excerpt_text:
+            excerpt_text = "\n" + excerpt_text
         return f"""
 作为TRPG主持人，基于剧本框架内自由发挥。回复限120字内。
 
 剧本：{script_data['title']}
 进度：{session_state['progress']}
 玩家行动：{player_action if player_action else "观察"}
-
+{excerpt_text}
 要求：
 1. 在剧本框架内创造性发挥
 2. 回复生动简洁，120字内
@@ -815,25 +2692,24 @@ class IntelligentKPDriver:
                 "stream": False
             }
             
-            # 发送请求
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(api_url, headers=headers, json=payload) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        
-                        # 解析响应（兼容不同API格式）
-                        if "choices" in result and len(result["choices"]) > 0:
-                            return result["choices"][0].get("message", {}).get("content", "").strip()
-                        elif "content" in result:
-                            return result["content"].strip()
-                        else:
-                            print(f"❌ 无法解析API响应: {result}")
-                            return None
+            # 发送请求（使用共享会话，保持与接口的长连接）
+            session = self._get_http_session()
+            async with session.post(api_url, headers=headers, json=payload) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    
+                    # 解析响应（兼容不同API格式）
+                    if "choices" in result and len(result["choices"]) > 0:
+                        return result["choices"][0].get("message", {}).get("content", "").strip()
+                    elif "content" in result:
+                        return result["content"].strip()
                     else:
-                        error_text = await response.text()
-                        print(f"❌ API请求失败: {response.status} - {error_text}")
+                        print(f"❌ 无法解析API响应: {result}")
                         return None
+                else:
+                    error_text = await response.text()
+                    print(f"❌ API请求失败: {response.status} - {error_text}")
+                    return None
                         
         except asyncio.TimeoutError:
             print("❌ LLM API请求超时")
@@ -859,6 +2735,25 @@ class IntelligentKPDriver:
 # 全局KP驱动器实例
 kp_driver = None
 
+# === 插件停止处理 ===
+class TRPGStopHandler(BaseEventHandler):
+    """插件停止时写入缓存中的修改并关闭LLM接口连接池"""
+    
+    event_type = EventType.ON_STOP
+    handler_name = "trpg_stop_handler"
+    handler_description = "写入TRPG插件待写盘数据并关闭LLM接口连接"
+    weight = 0
+    intercept_message = False
+    
+    async def execute(self, message) -> Tuple[bool, bool, Optional[str]]:
+        # 延迟写盘的角色修改否则只能等到进程退出时的atexit才写入，在线程中等待写盘完成
+        await asyncio.to_thread(flush_pending_writes)
+        print("💾 TRPG插件待写盘数据已写入")
+        if kp_driver:
+            await kp_driver.close()
+            print("🔌 TRPG插件LLM连接已关闭")
+        return True, True, None
+
 # === 全局帮助命令 ===
 class TRPGHelpCommand(BaseCommand):
     """TRPG全局帮助命令"""
@@ -963,9 +2858,8 @@ class StartCommand(BaseCommand):
                 return False, "模式错误", True
                 
             # 检查剧本是否存在
-            available_plots = get_available_plots()
-            if plot_name not in available_plots:
-                plot_list = "\n".join([f"- {plot}" for plot in available_plots])
+            if not plot_catalogue.contains(plot_name):
+                plot_list = "\n".join([f"- {plot}" for plot in get_available_plots()])
                 await self.send_text(
                     f"❌ 剧本 '{plot_name}' 不存在！\n\n"
                     f"📚 可用剧本列表:\n{plot_list}\n\n"
@@ -973,21 +2867,21 @@ class StartCommand(BaseCommand):
                 )
                 return False, "剧本不存在", True
                 
-            # 加载剧本内容
-            plot_content = await load_plot_content(plot_name)
-            if not plot_content or plot_content.startswith("❌"):
-                await self.send_text(f"❌ {plot_content or '剧本文件读取失败'}")
+            # 通过分段表校验剧本，会话只记录剧本名和内容哈希（哈希在线程中计算并缓存）
+            plot_table = await plot_segments.get_table(plot_name)
+            if not plot_table:
+                await self.send_text("❌ 剧本文件读取失败")
                 return False, "剧本读取失败", True
-                
+            
             # 生成会话
             session_id = generate_session_id()
             stream_id = getattr(chat_stream, 'stream_id', 'unknown')
             
-            active_sessions[session_id] = {
+            register_session({
                 "session_id": session_id,
                 "mode": mode,
                 "plot_name": plot_name,
-                "plot_content": plot_content[:5000],
+                "plot_ref": plot_table["sha256"],
                 "max_players": roles,
                 "creator": user_id,
                 "creator_uid": user_registry[str(user_id)],
@@ -1001,7 +2895,7 @@ class StartCommand(BaseCommand):
                 "created_time": datetime.now().isoformat(),
                 "last_activity": datetime.now().isoformat(),
                 "is_new_game": True  # 标记为新游戏
-            }
+            })
             
             # 初始化KP驱动器
             await kp_driver.initialize_script(session_id, plot_name)
@@ -1048,7 +2942,7 @@ class StartCommand(BaseCommand):
                     asyncio.create_task(self._prepare_phase_timeout(session_id))
                 else:
                     await self.send_text("❌ 没有玩家加入，剧本自动取消")
-                    del active_sessions[session_id]
+                    close_session(session_id)
 
     async def _prepare_phase_timeout(self, session_id: str):
         """准备阶段超时处理"""
@@ -1129,7 +3023,8 @@ class LoadCommand(BaseCommand):
                 await self.send_text("❌ 存档ID不存在")
                 return False, "存档不存在", True
                 
-            save_data = save_db[save_id]
+            # 会话会修改这些数据，复制一份以免改动内存中的存档
+            save_data = copy.deepcopy(save_db[save_id])
             user_uid = user_registry[str(user_id)]
             
             # 检查权限：只有团长或管理员可以加载存档
@@ -1137,6 +3032,15 @@ class LoadCommand(BaseCommand):
                 await self.send_text("❌ 您不是该存档的创建者，无法加载")
                 return False, "权限不足", True
             
+            # 用存档记录的内容哈希核对剧本文件，剧本被修改过时提醒进度可能对不上
+            plot_table = await plot_segments.get_table(save_data["plot_name"])
+            if not plot_table:
+                await self.send_text(f"❌ 存档使用的剧本 '{save_data['plot_name']}' 不存在或无法读取")
+                return False, "剧本不存在", True
+            plot_notice = ""
+            if save_data.get("plot_ref") and save_data["plot_ref"] != plot_table["sha256"]:
+                plot_notice = "⚠️ 剧本文件自存档后已修改，剧情进度可能与存档不一致\n"
+            
             # 获取聊天流信息
             chat_stream = getattr(self, 'chat_stream', None)
             if chat_stream is None:
@@ -1152,11 +3056,11 @@ class LoadCommand(BaseCommand):
             
             # 创建新会话
             session_id = generate_session_id()
-            active_sessions[session_id] = {
+            register_session({
                 "session_id": session_id,
                 "mode": save_data["mode"],
                 "plot_name": save_data["plot_name"],
-                "plot_content": save_data.get("plot_content", ""),
+                "plot_ref": plot_table["sha256"],
                 "max_players": save_data.get("max_players", 4),
                 "creator": user_id,
                 "creator_uid": user_uid,
@@ -1172,7 +3076,9 @@ class LoadCommand(BaseCommand):
                 "is_new_game": False,  # 标记为加载存档
                 "save_id": save_id,    # 关联的存档ID
                 "original_players": save_data.get("players", [])  # 保存原始玩家数据
-            }
+            })
+            # 新会话的增量存档以加载的存档为基准
+            save_delta_chain.heads[session_id] = save_id
             
             # 恢复KP驱动器状态
             if 'kp_driver_data' in save_data:
@@ -1190,7 +3096,8 @@ class LoadCommand(BaseCommand):
                 f"📜 剧本ID: `{session_id}`\n"
                 f"🎮 模式: {save_data['mode'].upper()}\n"
                 f"👥 原玩家数: {original_player_count}人\n"
-                f"⏰ 召集时间: 1分钟\n\n"
+                f"⏰ 召集时间: 1分钟\n"
+                f"{plot_notice}\n"
                 f"原玩家将自动匹配角色，新玩家可选择剩余角色\n"
                 f"请使用 `/join {session_id}` 加入游戏！"
             )
@@ -1242,7 +3149,7 @@ async def _start_session_after_delay(self, session_id: str):
                 asyncio.create_task(self._prepare_phase_timeout(session_id))
             else:
                 await self.send_text("❌ 没有玩家加入，剧本自动取消")
-                del active_sessions[session_id]
+                close_session(session_id)
     
     async def _show_help(self) -> Tuple[bool, Optional[str], bool]:
         """显示加载存档帮助"""
@@ -1304,10 +3211,12 @@ class JoinCommand(BaseCommand):
                 return False, "席位已满", True
                 
             # 检查是否已加入
-            for player in session["players"]:
-                if player["qq"] == user_id:
-                    await self.send_text("❌ 您已经加入了这个剧本")
-                    return False, "已加入", True
+            if get_session_player(session, user_id):
+                await self.send_text("❌ 您已经加入了这个剧本")
+                return False, "已加入", True
+            # 玩家仍在其他剧本（如存档后加载的原剧本）中时，索引转到新加入的剧本
+            previous_session_ids = player_session_index.get(str(user_id))
+            previous_session_id = previous_session_ids[-1] if previous_session_ids else None
                 
             # 添加玩家
             player_data = {
@@ -1319,12 +3228,16 @@ class JoinCommand(BaseCommand):
                 "status": "alive"
             }
             session["players"].append(player_data)
+            index_player(player_data, session_id)
             session["last_activity"] = datetime.now().isoformat()
             
-            await self.send_text(
+            join_text = (
                 f"✅ 玩家 {user_id} 成功加入剧本 {session['plot_name']}！\n"
                 f"当前玩家: {len(session['players'])}/{session['max_players']}"
             )
+            if previous_session_id and previous_session_id != session_id:
+                join_text += f"\n📌 您的命令将作用于本剧本（原剧本 {previous_session_id}）"
+            await self.send_text(join_text)
             
             return True, "加入剧本成功", True
             
@@ -1431,11 +3344,7 @@ class EnhancedSaveCommand(BaseCommand):
     async def _save_game(self, user_id: str) -> Tuple[bool, Optional[str], bool]:
         """保存游戏"""
         # 查找用户当前会话
-        current_session = None
-        for session in active_sessions.values():
-            if any(player["qq"] == user_id for player in session["players"]):
-                current_session = session
-                break
+        current_session = await get_user_session(user_id)
                 
         if not current_session:
             await self.send_text("❌ 您没有在活跃的剧本中")
@@ -1446,37 +3355,10 @@ class EnhancedSaveCommand(BaseCommand):
             await self.send_text("❌ 只有团长或管理员可以保存游戏")
             return False, "权限不足", True
             
-        # 生成存档ID
-        save_id = generate_save_id()
-        
-        # 获取KP驱动器状态
-        kp_state = None
-        if current_session["session_id"] in kp_driver.session_states:
-            kp_state = kp_driver.session_states[current_session["session_id"]]
-        
-        # 创建存档数据
-        save_data = {
-            "save_id": save_id,
-            "session_id": current_session["session_id"],
-            "plot_name": current_session["plot_name"],
-            "plot_content": current_session.get("plot_content", ""),
-            "mode": current_session["mode"],
-            "max_players": current_session["max_players"],
-            "players": current_session["players"],
-            "npcs": current_session["npcs"],
-            "items": current_session.get("items", []),
-            "current_progress": current_session["current_progress"],
-            "plot_progress": current_session.get("plot_progress", 0),
-            "save_time": datetime.now().isoformat(),
-            "creator": current_session["creator"],
-            "creator_uid": current_session["creator_uid"],
-            "status": "incomplete",
-            "kp_driver_data": kp_state  # 保存KP状态
-        }
-        
-        # 保存到数据库和文件
-        save_db[save_id] = save_data
-        save_save_data(save_data)
+        # 创建存档（包含KP驱动器状态）
+        save_data = create_session_save(current_session)
+        save_id = save_data["save_id"]
+        kp_state = save_data["kp_driver_data"]
         
         await self.send_text(
             f"💾 **游戏已保存！**\n"
@@ -1575,11 +3457,7 @@ class PrepareStatusCommand(BaseCommand):
                 return False, "用户未注册", True
                 
             # 查找用户当前会话
-            current_session = None
-            for session in active_sessions.values():
-                if any(player["qq"] == user_id for player in session["players"]):
-                    current_session = session
-                    break
+            current_session = await get_user_session(user_id)
                     
             if not current_session:
                 await self.send_text("❌ 您没有在活跃的剧本中")
@@ -1670,7 +3548,7 @@ class RegisterCommand(BaseCommand):
             # 生成新UID
             uid = generate_uid()
             user_registry[str(user_id)] = uid
-            save_user_registry()
+            save_user_registry(str(user_id), uid)
             
             await self.send_text(
                 f"🎉 注册成功！\n"
@@ -1785,7 +3663,6 @@ class RoleCommand(BaseCommand):
         }
         
         # 保存角色
-        character_db[rid] = character_data
         save_character(character_data)
         
         # 显示详细属性
@@ -1820,14 +3697,7 @@ class RoleCommand(BaseCommand):
             return False, "权限不足", True
             
         # 查找用户当前会话
-        current_session = None
-        for session in active_sessions.values():
-            for player in session["players"]:
-                if player["qq"] == user_id:
-                    current_session = session
-                    break
-            if current_session:
-                break
+        current_session = await get_user_session(user_id)
                 
         if not current_session:
             await self.send_text("❌ 您没有加入任何剧本")
@@ -1839,11 +3709,9 @@ class RoleCommand(BaseCommand):
             return False, "模式不匹配", True
             
         # 关联角色
-        for player in current_session["players"]:
-            if player["qq"] == user_id:
-                player["character_rid"] = rid
-                player["ready"] = True  # 标记为准备就绪
-                break
+        player = get_session_player(current_session, user_id)
+        player["character_rid"] = rid
+        player["ready"] = True  # 标记为准备就绪
                 
         # 显示详细属性
         mode = character["mode"]
@@ -1955,12 +3823,15 @@ class RoleCommand(BaseCommand):
             await self.send_text("❌ 您不是该角色的创建者")
             return False, "权限不足", True
         
-        # 检查角色是否正在使用
+        # 检查角色是否正在使用（包括休眠中的会话）
         for session in active_sessions.values():
             for player in session["players"]:
                 if player.get("character_rid") == rid:
                     await self.send_text("❌ 该角色正在剧本中使用，无法删除")
                     return False, "角色正在使用", True
+        if session_hibernator.uses_character(rid):
+            await self.send_text("❌ 该角色正在剧本中使用，无法删除")
+            return False, "角色正在使用", True
         
         # 删除角色
         character_name = character["name"]
@@ -2036,14 +3907,7 @@ class IntelligentActionCommand(BaseCommand):
                 return False, "用户未注册", True
             
             # 检查用户是否在活跃会话中
-            current_session = None
-            for session in active_sessions.values():
-                for player in session["players"]:
-                    if player["qq"] == user_id:
-                        current_session = session
-                        break
-                if current_session:
-                    break
+            current_session = await get_user_session(user_id)
             
             if not current_session:
                 await self.send_text("❌ 您没有在活跃的剧本中")
@@ -2150,6 +4014,7 @@ class CheckCommand(BaseCommand):
             'modifier': modifier,
             'mode': current_session["mode"],
             'stream_id': stream_id,
+            'session_id': current_session["session_id"],
             'is_simulate': False
         }
         
@@ -2311,11 +4176,7 @@ class CheckCommand(BaseCommand):
     
     async def _get_user_character(self, user_id: str) -> Tuple[Optional[Dict], Optional[Dict]]:
         """获取用户当前角色"""
-        for session in active_sessions.values():
-            for player in session["players"]:
-                if player["qq"] == user_id and player["character_rid"]:
-                    return session, character_db[player["character_rid"]]
-        return None, None
+        return await get_user_character(user_id)
     
     async def _show_help(self, user_id: str) -> Tuple[bool, Optional[str], bool]:
         """显示检定帮助"""
@@ -2528,11 +4389,7 @@ class StatusCommand(BaseCommand):
     
     async def _get_user_character(self, user_id: str) -> Tuple[Optional[Dict], Optional[Dict]]:
         """获取用户当前角色"""
-        for session in active_sessions.values():
-            for player in session["players"]:
-                if player["qq"] == user_id and player["character_rid"]:
-                    return session, character_db[player["character_rid"]]
-        return None, None
+        return await get_user_character(user_id)
     
     async def _show_help(self) -> Tuple[bool, Optional[str], bool]:
         """显示状态帮助"""
@@ -2568,7 +4425,7 @@ class PlotListCommand(BaseCommand):
             if hasattr(self, 'matched_groups') and self.matched_groups and self.matched_groups.get(0) == "help":
                 return await self._show_help()
                 
-            available_plots = get_available_plots()
+            available_plots = await plot_catalogue.describe()
             
             if not available_plots:
                 await self.send_text(
@@ -2579,11 +4436,16 @@ class PlotListCommand(BaseCommand):
                 return True, "无剧本文件", True
             
             plot_list = "📚 **可用剧本列表**\n\n"
-            for plot in available_plots:
-                plot_list += f"• {plot}\n"
+            for plot, info in available_plots:
+                plot_list += f"• {plot} ({info['size'] / 1024:.1f}KB, {info['segments']}段, {info['scenes']}个场景)\n"
             
             plot_list += f"\n💡 使用 `/start <模式> plot=剧本名` 开始游戏"
             
+            # 管理员额外查看剧本缓存状态
+            user_id = self.message.message_info.user_info.user_id
+            if kp_driver and is_admin(user_id, self.plugin):
+                plot_list += f"\n\n{kp_driver.script_cache.report()}"
+            
             await self.send_text(plot_list)
             return True, "显示剧本列表", True
             
@@ -2601,7 +4463,8 @@ class PlotListCommand(BaseCommand):
 **注意:**
 - 剧本文件需为.txt格式
 - 将剧本文件放入plugins/TRPG_Plugin/plots/目录
-- 使用剧本文件名（不含路径）开始游戏"""
+- 使用剧本文件名（不含路径）开始游戏
+- 管理员还会看到剧本缓存的命中率"""
         await self.send_text(help_text)
         return True, "显示剧本列表帮助", True
 
@@ -2629,11 +4492,7 @@ class SkipPrepareCommand(BaseCommand):
                 return False, "用户未注册", True
                 
             # 查找用户当前会话
-            current_session = None
-            for session in active_sessions.values():
-                if any(player["qq"] == user_id for player in session["players"]):
-                    current_session = session
-                    break
+            current_session = await get_user_session(user_id)
                     
             if not current_session:
                 await self.send_text("❌ 您没有在活跃的剧本中")
@@ -2720,11 +4579,7 @@ class KickCommand(BaseCommand):
                 return False, "用户未注册", True
                 
             # 查找用户当前会话
-            current_session = None
-            for session in active_sessions.values():
-                if any(player["qq"] == user_id for player in session["players"]):
-                    current_session = session
-                    break
+            current_session = await get_user_session(user_id)
                     
             if not current_session:
                 await self.send_text("❌ 您没有在活跃的剧本中")
@@ -2758,6 +4613,7 @@ class KickCommand(BaseCommand):
             
             # 从会话中移除玩家
             current_session["players"] = [p for p in current_session["players"] if p["uid"] != target_uid]
+            unindex_player(target_player, current_session["session_id"])
             
             await self.send_text(
                 f"🚪 **已踢出玩家**\n"
@@ -2823,11 +4679,7 @@ class CombatCommand(BaseCommand):
             target = self.matched_groups.get("target", "")
             
             # 查找用户当前会话
-            current_session = None
-            for session in active_sessions.values():
-                if any(player["qq"] == user_id for player in session["players"]):
-                    current_session = session
-                    break
+            current_session = await get_user_session(user_id)
                     
             if not current_session:
                 await self.send_text("❌ 您没有在活跃的剧本中")
@@ -3035,11 +4887,7 @@ class NPCCommand(BaseCommand):
             params = self.matched_groups.get("params", "")
             
             # 查找用户当前会话
-            current_session = None
-            for session in active_sessions.values():
-                if any(player["qq"] == user_id for player in session["players"]):
-                    current_session = session
-                    break
+            current_session = await get_user_session(user_id)
                     
             if not current_session:
                 await self.send_text("❌ 您没有在活跃的剧本中")
@@ -3228,7 +5076,7 @@ class ItemCommand(BaseCommand):
             "obtained_time": datetime.now().isoformat()
         })
         
-        save_character(target_character)
+        mark_character_dirty(target_character)
         
         await self.send_text(
             f"✅ 物品分配成功！\n"
@@ -3260,11 +5108,7 @@ class ItemCommand(BaseCommand):
     
     async def _get_user_character(self, user_id: str) -> Tuple[Optional[Dict], Optional[Dict]]:
         """获取用户角色"""
-        for session in active_sessions.values():
-            for player in session["players"]:
-                if str(player["qq"]) == str(user_id) and player["character_rid"]:
-                    return session, character_db[player["character_rid"]]
-        return None, None
+        return await get_user_character(user_id)
     
     async def _show_help(self) -> Tuple[bool, Optional[str], bool]:
         """显示物品帮助"""
@@ -3313,12 +5157,7 @@ class PlotAdvancerAction(BaseAction):
         try:
             # 获取当前会话
             stream_id = getattr(self.chat_stream, 'stream_id', 'unknown')
-            current_session = None
-            
-            for session in active_sessions.values():
-                if session.get('stream_id') == stream_id:
-                    current_session = session
-                    break
+            current_session = await get_stream_session(stream_id)
                     
             if not current_session:
                 return False, "未找到当前游戏会话"
@@ -3347,7 +5186,7 @@ class TRPGPlugin(BasePlugin):
     enable_plugin = True
     
     dependencies = []
-    python_dependencies = ["aiofiles", "aiohttp", "toml"]
+    python_dependencies = ["aiohttp", "toml"]
     
     config_file_name = "config.toml"
     config_section_descriptions = {
@@ -3355,7 +5194,8 @@ class TRPGPlugin(BasePlugin):
         "llm": "AI模型配置",
         "game": "游戏规则配置",
         "combat": "战斗系统配置",
-        "admin": "管理员配置"
+        "admin": "管理员配置",
+        "storage": "数据存储配置"
     }
     
     config_schema = {
@@ -3367,11 +5207,17 @@ class TRPGPlugin(BasePlugin):
             "plot_model": ConfigField(type=str, default="Qwen/Qwen2.5-14B-Instruct", description="剧情推进模型"),
             "api_url": ConfigField(type=str, default="https://api.siliconflow.cn/v1/chat/completions", description="模型API地址"),
             "api_key": ConfigField(type=str, default="", description="API密钥"),
-            "temperature": ConfigField(type=float, default=0.8, description="生成随机性")
+            "temperature": ConfigField(type=float, default=0.8, description="生成随机性"),
+            "retrieval_top_k": ConfigField(type=int, default=3, description="每次行动注入提示词的剧本片段数，0为不注入"),
+            "max_connections": ConfigField(type=int, default=8, description="LLM接口连接池的最大连接数")
         },
         "game": {
             "default_mode": ConfigField(type=str, default="coc", description="默认规则模式"),
-            "max_players": ConfigField(type=int, default=6, description="最大玩家数")
+            "max_players": ConfigField(type=int, default=6, description="最大玩家数"),
+            "session_idle_hours": ConfigField(type=float, default=0.0, description="会话空闲回收时限(小时)，0为不回收（默认）"),
+            "session_hibernate_hours": ConfigField(type=float, default=0.0, description="会话空闲休眠时限(小时)，0为不休眠"),
+            "script_cache_mb": ConfigField(type=float, default=32.0, description="剧本缓存内存上限(MB)"),
+            "keyword_dict": ConfigField(type=str, default="", description="自定义关键词词典（JSON，相对插件目录），留空不加载")
         },
         "combat": {
             "round_timeout": ConfigField(type=int, default=120, description="回合超时时间(秒)"),
@@ -3379,6 +5225,15 @@ class TRPGPlugin(BasePlugin):
         },
         "admin": {
             "admin_users": ConfigField(type=list, default=[], description="管理员QQ号列表")
+        },
+        "storage": {
+            "backend": ConfigField(type=str, default="file", description="存储后端 (file/sqlite)"),
+            "sqlite_path": ConfigField(type=str, default="trpg.db", description="SQLite数据库文件（相对插件目录）"),
+            "write_coalesce_seconds": ConfigField(type=float, default=5.0, description="角色修改合并写盘窗口(秒)"),
+            "incremental_saves": ConfigField(type=bool, default=False, description="增量存档（只记录相对上一次存档变化的字段）"),
+            "save_chain_max_length": ConfigField(type=int, default=8, description="增量存档链最大长度，超过后写入完整存档"),
+            "roles_codec": ConfigField(type=str, default="json", description="角色文件编码 (json/gzip/zstd)"),
+            "saves_codec": ConfigField(type=str, default="json", description="存档文件编码 (json/gzip/zstd)")
         }
     }
     
@@ -3386,10 +5241,29 @@ class TRPGPlugin(BasePlugin):
         super().__init__(*args, **kwargs)
         print(f"🔧 TRPG插件初始化中...")
         self._ensure_config_exists()
+        # 初始化存储后端（先等待旧后端的写盘任务完成）
+        global storage_backend
+        flush_pending_writes()
+        storage_backend = create_storage_backend(self)
+        character_write_behind.window = self.get_config("storage.write_coalesce_seconds", 5.0)
+        save_delta_chain.enabled = self.get_config("storage.incremental_saves", False)
+        save_delta_chain.max_length = self.get_config("storage.save_chain_max_length", 8)
+        save_expiry.retention_days = self.get_config("plugin.auto_clean_days", 10)
+        session_reaper.idle_hours = self.get_config("game.session_idle_hours", 0)
+        session_hibernator.idle_hours = self.get_config("game.session_hibernate_hours", 0)
+        if 0 < session_reaper.idle_hours <= session_hibernator.idle_hours:
+            print(f"⚠️ game.session_hibernate_hours ({session_hibernator.idle_hours}) 不小于 "
+                  f"game.session_idle_hours ({session_reaper.idle_hours})，空闲会话会在休眠前被回收")
+        keyword_dict = self.get_config("game.keyword_dict", "")
+        if keyword_dict:
+            keyword_engine.load_custom(PLUGIN_DIR / keyword_dict)
+        print(f"💾 存储后端: {storage_backend.name}")
         # 加载所有数据
         load_user_registry()
         load_character_db()
         load_save_db()
+        storage_backend.save_snapshot()
+        session_hibernator.restore()
         
         # 初始化KP驱动器，传入插件实例
         global kp_driver
@@ -3418,11 +5292,17 @@ class TRPGPlugin(BasePlugin):
                 "plot_model": "Qwen/Qwen2.5-14B-Instruct",
                 "api_url": "https://api.siliconflow.cn/v1/chat/completions", 
                 "api_key": "",
-                "temperature": 0.8
+                "temperature": 0.8,
+                "retrieval_top_k": 3,
+                "max_connections": 8
             },
             "game": {
                 "default_mode": "coc",
-                "max_players": 6
+                "max_players": 6,
+                "session_idle_hours": 0.0,
+                "session_hibernate_hours": 0.0,
+                "script_cache_mb": 32.0,
+                "keyword_dict": ""
             },
             "combat": {
                 "round_timeout": 120,
@@ -3430,6 +5310,15 @@ class TRPGPlugin(BasePlugin):
             },
             "admin": {
                 "admin_users": []
+            },
+            "storage": {
+                "backend": "file",
+                "sqlite_path": "trpg.db",
+                "write_coalesce_seconds": 5.0,
+                "incremental_saves": False,
+                "save_chain_max_length": 8,
+                "roles_codec": "json",
+                "saves_codec": "json"
             }
         }
         
@@ -3447,10 +5336,16 @@ plot_model = "{default_config["llm"]["plot_model"]}"
 api_url = "{default_config["llm"]["api_url"]}"
 api_key = "{default_config["llm"]["api_key"]}"
 temperature = {default_config["llm"]["temperature"]}
+retrieval_top_k = {default_config["llm"]["retrieval_top_k"]}
+max_connections = {default_config["llm"]["max_connections"]}
 
 [game]
 default_mode = "{default_config["game"]["default_mode"]}"
 max_players = {default_config["game"]["max_players"]}
+session_idle_hours = {default_config["game"]["session_idle_hours"]}
+session_hibernate_hours = {default_config["game"]["session_hibernate_hours"]}
+script_cache_mb = {default_config["game"]["script_cache_mb"]}
+keyword_dict = "{default_config["game"]["keyword_dict"]}"
 
 [combat]
 round_timeout = {default_config["combat"]["round_timeout"]}
@@ -3458,6 +5353,15 @@ enable_auto_initiative = {str(default_config["combat"]["enable_auto_initiative"]
 
 [admin]
 admin_users = {default_config["admin"]["admin_users"]}
+
+[storage]
+backend = "{default_config["storage"]["backend"]}"
+sqlite_path = "{default_config["storage"]["sqlite_path"]}"
+write_coalesce_seconds = {default_config["storage"]["write_coalesce_seconds"]}
+incremental_saves = {str(default_config["storage"]["incremental_saves"]).lower()}
+save_chain_max_length = {default_config["storage"]["save_chain_max_length"]}
+roles_codec = "{default_config["storage"]["roles_codec"]}"
+saves_codec = "{default_config["storage"]["saves_codec"]}"
 """
             
             with open(config_path, 'w', encoding='utf-8') as f:
@@ -3495,39 +5399,113 @@ admin_users = {default_config["admin"]["admin_users"]}
             (NPCCommand.get_command_info(), NPCCommand),
             (ItemCommand.get_command_info(), ItemCommand),
             (PrepareStatusCommand.get_command_info(), PrepareStatusCommand),
-            (PlotAdvancerAction.get_action_info(), PlotAdvancerAction)
+            (PlotAdvancerAction.get_action_info(), PlotAdvancerAction),
+            (TRPGStopHandler.get_handler_info(), TRPGStopHandler)
         ]
         print(f"📋 TRPG插件注册了 {len(components)} 个组件")
         return components
 
 # 定时清理任务
+class SaveExpiry:
+    """存档过期清理 - 按存档目录的时间顺序定位过期存档，删除在持久化线程中执行"""
+    
+    def __init__(self, retention_days: int = 10, interval: float = 24 * 60 * 60):
+        self.retention_days = retention_days
+        self.interval = interval
+        self.stats = {"runs": 0, "reclaimed": 0, "last_reclaimed": 0, "last_elapsed": 0.0, "last_run": None}
+    
+    async def run_once(self) -> int:
+        """清理一次过期存档，返回清理数量"""
+        start_time = time.perf_counter()
+        cutoff_time = datetime.now() - timedelta(days=self.retention_days)
+        # 通过存档目录定位过期存档，无需逐个读取存档文件；
+        # 从新到旧删除，增量存档先于其父存档删除，避免无谓的折叠写盘
+        expired = save_catalogue.expired(cutoff_time.isoformat())
+        expired.reverse()
+        futures = [future for future in delete_saves(expired) if asyncio.isfuture(future)]
+        failed = 0
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                failed += 1
+        
+        reclaimed = len(expired) - failed
+        elapsed = time.perf_counter() - start_time
+        self.stats["runs"] += 1
+        self.stats["reclaimed"] += reclaimed
+        self.stats["last_reclaimed"] = reclaimed
+        self.stats["last_elapsed"] = elapsed
+        self.stats["last_run"] = datetime.now().isoformat()
+        if expired:
+            print(f"🗑️ 已清理 {reclaimed} 个超过 {self.retention_days} 天的旧存档"
+                  f"{f'，{failed} 个删除失败' if failed else ''}，耗时 {elapsed:.2f}s")
+        return reclaimed
+
+save_expiry = SaveExpiry()
+
+class SessionReaper:
+    """空闲会话回收 - 自动存档并清理超过空闲时限的会话"""
+    
+    def __init__(self, idle_hours: float = 0, interval: float = 10 * 60):
+        self.idle_hours = idle_hours  # 为0时不回收
+        self.interval = interval
+        self.stats = {"reaped": 0, "autosaved": 0}
+    
+    def reap_once(self) -> int:
+        """回收一次空闲会话，返回回收数量"""
+        if self.idle_hours <= 0:
+            return 0
+        cutoff_time = (datetime.now() - timedelta(hours=self.idle_hours)).isoformat()
+        reaped = 0
+        # 休眠会话已完整保存在磁盘上，不回收，留待玩家回来时恢复
+        for session_id, session in list(active_sessions.items()):
+            if session.get("last_activity", session.get("created_time", "")) >= cutoff_time:
+                continue
+            # 只有进行中的会话有需要保留的进度，招募和准备阶段直接关闭
+            if session.get("status") == "playing":
+                try:
+                    save_data = create_session_save(session)
+                    self.stats["autosaved"] += 1
+                    print(f"💾 空闲会话 {session_id} 已自动存档: {save_data['save_id']}")
+                except Exception as e:
+                    print(f"❌ 空闲会话 {session_id} 自动存档失败，暂不回收: {e}")
+                    continue
+            close_session(session_id)
+            reaped += 1
+        self.stats["reaped"] += reaped
+        if reaped:
+            print(f"🔄 已回收 {reaped} 个空闲超过 {self.idle_hours} 小时的会话")
+        return reaped
+
+session_reaper = SessionReaper()
+
+async def reap_idle_sessions():
+    """定期回收空闲会话"""
+    while True:
+        await asyncio.sleep(session_reaper.interval)
+        try:
+            session_reaper.reap_once()
+        except Exception as e:
+            print(f"回收空闲会话失败: {e}")
+
+async def hibernate_idle_sessions():
+    """定期休眠空闲会话"""
+    while True:
+        await asyncio.sleep(session_hibernator.interval)
+        try:
+            await session_hibernator.hibernate_idle()
+        except Exception as e:
+            print(f"休眠空闲会话失败: {e}")
+
 async def cleanup_old_saves():
     """清理旧存档"""
     while True:
-        await asyncio.sleep(24 * 60 * 60)  # 每天执行一次
-        
-        auto_clean_days = 10  # 默认10天
-        cutoff_time = datetime.now() - timedelta(days=auto_clean_days)
-        
-        for save_file in SAVES_DIR.glob("*.json"):
-            try:
-                with open(save_file, 'r', encoding='utf-8') as f:
-                    save_data = json.load(f)
-                
-                save_time = datetime.fromisoformat(save_data.get('save_time', '2000-01-01'))
-                if save_time < cutoff_time:
-                    save_file.unlink()
-                    save_id = save_data.get('save_id')
-                    if save_id in save_db:
-                        del save_db[save_id]
-                    print(f"已清理旧存档: {save_file.name}")
-            except:
-                continue
+        await asyncio.sleep(save_expiry.interval)  # 每天执行一次
+        try:
+            await save_expiry.run_once()
+        except Exception as e:
+            print(f"清理存档失败: {e}")
 
 # 启动清理任务
 asyncio.create_task(cleanup_old_saves())
-
-# 启动时加载数据
-load_user_registry()
-load_character_db()
-load_save_db()
\ No newline at end of file
+asyncio.create_task(reap_idle_sessions())
+asyncio.create_task(hibernate_idle_sessions())